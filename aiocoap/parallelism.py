@@ -0,0 +1,1030 @@
+# This file is part of the Python aiocoap library project.
+#
+# Copyright (c) 2012-2014 Maciej Wasilak <http://sixpinetrees.blogspot.com/>,
+#               2013-2014 Christian Amsüss <c.amsuess@energyharvesting.at>
+#
+# aiocoap is free software, this file is published under the MIT license as
+# described in the accompanying LICENSE file.
+
+"""Scatter-gather over the members of a parallelism entity
+
+A :class:`CoordinatorResource` accepts a single PARALLELIZE request, sends it
+on to every member of a parallelism entity (see the parallelism directory
+methods of :class:`.resource.Site`) through its own :class:`.Context`, and
+answers with the members' responses combined by a reducer like
+:class:`TopKReducer`. That way, a client only needs a single round trip to the
+coordinator, and the fan-out happens on the coordinator's side of the network.
+
+A :class:`StragglerPolicy` keeps slow or failed members from holding up the
+whole response: their share of the work is sent to another member once they
+exceed a deadline or fail, and slow shares can be hedged with a duplicate
+request to another member. With a deadline for the whole request, the
+coordinator answers with what it has by then, and tells which shares are
+missing.
+
+Directories can keep track of their members' lifetimes with :class:`Leases`,
+persist them across restarts in a :class:`Journal`, and spread the
+partitions of a data set over them with :func:`rendezvous`.
+
+Clients that do the fan-out themselves can merge top-k results with
+:class:`TopK`, or with :func:`top_k_as_completed` while the members' responses
+are still arriving.
+
+This is work in progress and not yet part of the API."""
+
+import asyncio
+import collections
+import hashlib
+import heapq
+import json
+import math
+import os
+import time
+
+from . import error
+from . import message
+from . import numbers
+from . import resource
+from .util import hostportjoin
+
+class MemberFailed(error.Error):
+    """Raised when a member of the parallelism entity could not be reached
+    or responded with a server error"""
+
+class MemberRejected(error.Error):
+    """Raised when a member of the parallelism entity rejected a request
+    with a client error, which any other member would do just the same;
+    the member's `response` is passed on to the client"""
+
+    def __init__(self, response):
+        super().__init__("Member responded %s" % response.code)
+        self.response = response
+
+class Leases:
+    """Expiry times of a directory's leases (say, of the members of a
+    parallelism entity), which are renewed by the holders' heartbeats
+
+    All leases share a single timer on the event loop that is set to the
+    earliest expiry, rather than there being one task per lease like in the
+    resource directory; `on_expiry` is called with the key of every lease
+    that runs out.
+
+    Expiry times are kept in a heap that renewals add entries to; entries
+    that were superseded by a renewal are skipped when they come up, and
+    purged whenever they make up most of the heap."""
+
+    def __init__(self, on_expiry, loop=None):
+        self.on_expiry = on_expiry
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self._expiries = {}
+        # (expiry time, insertion count, key); the count keeps keys from
+        # ever being compared
+        self._heap = []
+        self._counter = 0
+        self._timer = None
+        # TimerHandle.when() is only available from Python 3.7 on
+        self._timer_when = None
+
+    def __contains__(self, key):
+        return key in self._expiries
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def remaining(self, key):
+        """Seconds until the lease of `key` runs out"""
+        return self._expiries[key] - self.loop.time()
+
+    def renew(self, key, lifetime):
+        """Create or renew the lease of `key` to run out in `lifetime`
+        seconds"""
+        expiry = self.loop.time() + lifetime
+        self._expiries[key] = expiry
+        heapq.heappush(self._heap, (expiry, self._counter, key))
+        self._counter += 1
+
+        if len(self._heap) > 2 * len(self._expiries) + 16:
+            self._heap = [(e, c, k) for (e, c, k) in self._heap if self._expiries.get(k) == e]
+            heapq.heapify(self._heap)
+
+        self._schedule()
+
+    def cancel(self, key):
+        """End the lease of `key` without calling `on_expiry`"""
+        del self._expiries[key]
+        self._schedule()
+
+    def _schedule(self):
+        # drop superseded and cancelled entries from the top, so that the
+        # timer is set for a lease that is actually running
+        while self._heap and self._expiries.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+        when = self._heap[0][0] if self._heap else None
+        if self._timer is not None:
+            if when is not None and self._timer_when == when:
+                return
+            self._timer.cancel()
+            self._timer = None
+            self._timer_when = None
+        if when is not None:
+            self._timer = self.loop.call_at(when, self._expire)
+            self._timer_when = when
+
+    def _expire(self):
+        self._timer = None
+        self._timer_when = None
+        now = self.loop.time()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            expiry, count, key = heapq.heappop(self._heap)
+            if self._expiries.get(key) == expiry:
+                del self._expiries[key]
+                expired.append(key)
+        self._schedule()
+
+        for key in expired:
+            self.on_expiry(key)
+
+def _tuples(value):
+    # JSON turns tuples into lists, which can't be dictionary keys
+    if isinstance(value, list):
+        return tuple(_tuples(v) for v in value)
+    return value
+
+class Journal:
+    """Key-value state that survives restarts of a directory (say, the
+    members of its parallelism entities), stored in the files `path` +
+    ``.snapshot`` and `path` + ``.journal``.
+
+    Keys are tuples, and both keys and values need to be representable in
+    JSON (with tuples in keys coming back as tuples). Every :meth:`put` and
+    :meth:`delete` is appended to the journal as one line of JSON; once the
+    journal has grown to more than twice as many records as there are keys
+    (plus `slack`), the whole state is written to a new snapshot, and the
+    journal starts over. Loading the state on startup thus takes time in
+    the order of the number of keys, no matter how long the directory ran.
+
+    With `sync`, every change is flushed to disk before :meth:`put` or
+    :meth:`delete` return; otherwise, a crash of the host (but not of the
+    process) can lose the last changes.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "state")
+    >>> journal = Journal(path)
+    >>> journal.put(("member", ("192.0.2.1", 5001)), {"capacity": 2})
+    >>> journal.put(("member", ("192.0.2.2", 5002)), {"capacity": 1})
+    >>> journal.delete(("member", ("192.0.2.1", 5001)))
+    >>> journal.close()
+    >>> list(Journal(path).items(("member",)))
+    [(('member', ('192.0.2.2', 5002)), {'capacity': 1})]
+    """
+
+    def __init__(self, path, slack=64, sync=False):
+        self.path = path
+        self.slack = slack
+        self.sync = sync
+
+        self._state = {}
+        self._records = 0
+        self._file = None
+        self._load()
+
+        # start over from a snapshot, which also gets rid of a last record
+        # that a crash may have left half written
+        self._compact()
+
+    def _load(self):
+        try:
+            with open(self.path + ".snapshot") as f:
+                for key, value in json.load(f):
+                    self._state[_tuples(key)] = value
+        except FileNotFoundError:
+            pass
+
+        try:
+            with open(self.path + ".journal") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if len(record) > 1:
+                        self._state[_tuples(record[0])] = record[1]
+                    else:
+                        self._state.pop(_tuples(record[0]), None)
+        except FileNotFoundError:
+            pass
+
+    def _write(self, f):
+        f.flush()
+        if self.sync:
+            os.fsync(f.fileno())
+
+    def _compact(self):
+        scratch = self.path + ".snapshot.tmp"
+        with open(scratch, "w") as f:
+            json.dump([[key, value] for key, value in self._state.items()], f)
+            self._write(f)
+        os.replace(scratch, self.path + ".snapshot")
+
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path + ".journal", "w")
+        self._records = 0
+
+    def _append(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._write(self._file)
+        self._records += 1
+        if self._records > 2 * len(self._state) + self.slack:
+            self._compact()
+
+    def get(self, key, default=None):
+        return self._state.get(key, default)
+
+    def items(self, prefix=()):
+        """The (key, value) pairs whose keys start with `prefix`"""
+        return [(key, value) for key, value in self._state.items()
+                if key[:len(prefix)] == prefix]
+
+    def put(self, key, value):
+        if key in self._state and self._state[key] == value:
+            return
+        self._state[key] = value
+        self._append([key, value])
+
+    def delete(self, key):
+        if key not in self._state:
+            return
+        del self._state[key]
+        self._append([key])
+
+    def close(self):
+        self._file.close()
+
+def _hash_unit(key, candidate):
+    # uniformly distributed in (0, 1), and the same in every process
+    digest = hashlib.sha256(repr((key, candidate)).encode('utf8')).digest()
+    return (int.from_bytes(digest[:8], 'big') + 0.5) / 2 ** 64
+
+def rendezvous(key, candidates, weights=None, count=1):
+    """The `count` candidates that `key` (say, a partition of a data set) is
+    assigned to by weighted rendezvous hashing, best first.
+
+    Every candidate gets a pseudo-random score for the key that is scaled by
+    its weight (given in the `weights` mapping, 1 by default), and the
+    highest scores win; over many keys, each candidate wins a share that is
+    proportional to its weight. As the scores of a key do not depend on the
+    other candidates, adding a candidate only moves the keys that it wins to
+    it, and removing one only moves the keys that it had won.
+
+    >>> before = {p: rendezvous(p, ["a", "b", "c"])[0] for p in range(100)}
+    >>> after = {p: rendezvous(p, ["a", "b", "c", "d"])[0] for p in range(100)}
+    >>> all(after[p] in (before[p], "d") for p in range(100))
+    True
+    """
+    def score(candidate):
+        weight = weights.get(candidate, 1) if weights is not None else 1
+        return -weight / math.log(_hash_unit(key, candidate))
+
+    return sorted(candidates, key=score, reverse=True)[:count]
+
+class _Reversed:
+    """Wrapper that orders keys the other way round, which turns heapq's
+    min-heaps into max-heaps"""
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+class TopK:
+    """The `k` smallest items (by `key`) out of all items added so far
+
+    Items are kept in a bounded heap, so adding n items takes O(n log k)
+    time and O(k) memory no matter how many lists they arrive in.
+
+    >>> best = TopK(3, key=lambda item: item[1])
+    >>> best.add([("a", 5), ("b", 1)])
+    True
+    >>> best.add([("c", 7), ("d", 2), ("e", 9)])
+    True
+    >>> best.add([("f", 8)])
+    False
+    >>> best.items()
+    [('b', 1), ('d', 2), ('a', 5)]
+    """
+
+    def __init__(self, k, key=None):
+        self.k = k
+        self.key = key if key is not None else (lambda item: item)
+
+        # max-heap (on the key) of (reversed key, insertion count, item)
+        # tuples, so that the worst of the best items is at the top; the
+        # count keeps items with equal keys from ever being compared
+        self._heap = []
+        self._counter = 0
+
+    def add(self, items):
+        """Add a number of items, and return whether they changed the best
+        items"""
+        changed = False
+        for item in items:
+            entry = (_Reversed(self.key(item)), self._counter, item)
+            self._counter += 1
+            if len(self._heap) < self.k:
+                heapq.heappush(self._heap, entry)
+                changed = True
+            elif self._heap and entry[0].key < self._heap[0][0].key:
+                heapq.heapreplace(self._heap, entry)
+                changed = True
+        return changed
+
+    def items(self):
+        """The best items so far in ascending order of their keys"""
+        return [item for (key, count, item) in sorted(self._heap, reverse=True)]
+
+class top_k_as_completed:
+    """Asynchronous iterator that merges the lists of items that the
+    awaitables `aws` produce into the `k` best items (see :class:`TopK`) as
+    they complete, producing the best items so far whenever they changed.
+
+    If one of the awaitables raises, the others are cancelled before the
+    exception is passed on. Consumers that stop iterating early need to call
+    :meth:`aclose` to cancel the outstanding ones, which using the iterator
+    in an ``async with`` block takes care of."""
+    def __init__(self, aws, k, key=None):
+        self._best = TopK(k, key)
+        self._pending = [asyncio.ensure_future(aw) for aw in aws]
+        self._completed = iter(asyncio.as_completed(self._pending))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        for completed in self._completed:
+            try:
+                items = await completed
+            except BaseException:
+                await self.aclose()
+                raise
+            if self._best.add(items):
+                return self._best.items()
+        raise StopAsyncIteration
+
+    async def aclose(self):
+        """Cancel the awaitables that have not completed yet, and wait for
+        them to finish"""
+        self._completed = iter(())
+        pending = [future for future in self._pending if not future.done()]
+        for future in pending:
+            future.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        # the results are not of interest any more, not even their errors
+        for future in self._pending:
+            if not future.cancelled():
+                future.exception()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+class TopKReducer:
+    """Reducer for members that respond with JSON lists of items ranked by
+    `key`, typically the `k` best results out of their share of the data.
+
+    The lists are merged through a :class:`TopK`, and the best `k` items of
+    all of them are returned as a JSON list. `k` can also be a function that
+    tells it from the request. If `k` is not given, as many items are
+    returned as the longest member response contained; all items need to be
+    kept until the end then.
+
+    Requests for which the optional `batch` function returns True carry
+    several queries, and their members respond with a list of such lists (or
+    nulls) per query. Those are merged query by query, and the result is a
+    list of the best items (or null, if no member had any) per query.
+
+    If shares are missing, the result is a partial one, and is returned as a
+    JSON object with the list as ``results`` and the missing share numbers as
+    ``missing``.
+
+    Responses can also be merged one at a time as they arrive, through the
+    object returned by :meth:`start`. Subclasses can read members' responses
+    in other formats than JSON by overriding :meth:`decode`, and setting
+    ``accept`` to the format that members are asked for.
+
+    >>> reducer = TopKReducer(key=lambda item: item[1])
+    >>> responses = [message.Message(payload=b'[["a", 1], ["c", 3]]'),
+    ...         message.Message(payload=b'[["b", 2], ["d", 4]]')]
+    >>> reducer(None, responses).payload
+    b'[["a", 1], ["b", 2]]'
+    >>> reducer(None, responses[1:], missing=[0]).payload
+    b'{"results": [["b", 2], ["d", 4]], "missing": [0]}'
+    >>> reducer = TopKReducer(key=lambda item: item[1], batch=lambda request: True)
+    >>> responses = [message.Message(payload=b'[[["a", 1], ["c", 3]], null]'),
+    ...         message.Message(payload=b'[[["b", 2]], null]')]
+    >>> reducer(None, responses).payload
+    b'[[["a", 1], ["b", 2]], null]'
+    """
+
+    content_format = numbers.media_types_rev['application/json']
+
+    def __init__(self, key=None, k=None, batch=None):
+        self.key = key
+        self.k = k
+        self.batch = batch
+
+    def start(self, request):
+        """Start merging the responses to `request` one at a time. The
+        returned object's ``add(response)`` method takes every response as it
+        arrives, and keeps only the best items so far; its
+        ``finish(missing)`` method then returns the response message like
+        calling the reducer would.
+
+        >>> merge = TopKReducer(key=lambda item: item[1], k=1).start(None)
+        >>> merge.add(message.Message(payload=b'[["a", 3]]'))
+        >>> merge.add(message.Message(payload=b'[["b", 2]]'))
+        >>> merge.finish([2]).payload
+        b'{"results": [["b", 2]], "missing": [2]}'
+        """
+        return _TopKMerge(self, request)
+
+    def decode(self, response, batch):
+        """The lists of items in a member's `response`: one per query (or None
+        for queries the member had nothing for) for a `batch`, or a single
+        one"""
+        lists = json.loads(response.payload.decode('utf8'))
+        return lists if batch else [lists]
+
+    def __call__(self, request, responses, missing=()):
+        merge = self.start(request)
+        for response in responses:
+            merge.add(response)
+        return merge.finish(missing)
+
+class _TopKMerge:
+    """State of a :class:`TopKReducer` merging the responses to a single
+    request as they arrive"""
+
+    def __init__(self, reducer, request):
+        self.reducer = reducer
+        self.k = reducer.k(request) if callable(reducer.k) else reducer.k
+        self.batch = reducer.batch is not None and reducer.batch(request)
+        # best items so far and the length of the longest list, per query;
+        # None for queries that no member had any items for yet
+        self._best = []
+        self._longest = []
+
+    def add(self, response):
+        for i, items in enumerate(self.reducer.decode(response, self.batch)):
+            if i == len(self._best):
+                self._best.append(None)
+                self._longest.append(0)
+            if items is None:
+                continue
+            if self._best[i] is None:
+                self._best[i] = TopK(self.k if self.k is not None else math.inf, self.reducer.key)
+            self._best[i].add(items)
+            self._longest[i] = max(self._longest[i], len(items))
+
+    def finish(self, missing=()):
+        results = [None if best is None else
+                best.items() if self.k is not None else best.items()[:longest]
+                for (best, longest) in zip(self._best, self._longest)]
+        if self.batch:
+            result = results
+        else:
+            result = results[0] if results and results[0] is not None else []
+
+        if missing:
+            result = {"results": result, "missing": list(missing)}
+
+        return message.Message(code=numbers.codes.COMPUTED, content_format=self.reducer.content_format,
+                payload=json.dumps(result).encode('utf8'))
+
+class _CollectedResponses:
+    """Stand-in for the object returned by :meth:`TopKReducer.start` for
+    reducers that only take all responses at once"""
+
+    def __init__(self, reducer, request):
+        self.reducer = reducer
+        self.request = request
+        self.responses = []
+
+    def add(self, response):
+        self.responses.append(response)
+
+    def finish(self, missing=()):
+        return self.reducer(self.request, self.responses, missing)
+
+class StragglerPolicy:
+    """Rules for when a :class:`CoordinatorResource` sends a share of the
+    work to more than one member
+
+    Every request to a member is given up (and cancelled) after `deadline`
+    seconds; None leaves that to CoAP's own timeouts, which can take over a
+    minute and a half for a member that is gone.
+
+    Once `min_samples` of the last `samples` members' response times are
+    known, a share that did not get a response within their
+    `hedge_percentile` is hedged: a duplicate request is sent to another
+    member, and whichever response comes first is used. None disables
+    hedging.
+
+    Shares whose member failed (or did not respond within the deadline) are
+    re-dispatched to another member right away. No share is sent out more
+    than `attempts` times, counting hedges and re-dispatches.
+
+    >>> policy = StragglerPolicy(hedge_percentile=90, min_samples=10)
+    >>> policy.hedge_delay() is None
+    True
+    >>> for i in range(1, 11):
+    ...     policy.record(i / 100)
+    >>> policy.hedge_delay()
+    0.09
+    """
+
+    def __init__(self, deadline=None, hedge_percentile=95, min_samples=20, samples=100, attempts=3):
+        self.deadline = deadline
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.attempts = attempts
+
+        self._latencies = collections.deque(maxlen=samples)
+
+    def record(self, latency):
+        """Note the response time of a successful request to a member"""
+        self._latencies.append(latency)
+
+    def hedge_delay(self):
+        """Time after which a share should be hedged, or None if it should
+        not be (yet)"""
+        if self.hedge_percentile is None or len(self._latencies) < self.min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        rank = math.ceil(self.hedge_percentile / 100 * len(latencies)) - 1
+        return latencies[max(rank, 0)]
+
+# what coordinators without a policy do: wait for every member for as long as
+# CoAP does, and give up on the first failure
+_NO_STRAGGLER_POLICY = StragglerPolicy(hedge_percentile=None, attempts=1)
+
+Share = collections.namedtuple("Share", ["members", "data"])
+Share.__doc__ = """Share of the work of a :class:`CoordinatorResource`: the list of
+`members` responsible for it (possibly empty), and any `data` that
+:meth:`CoordinatorResource.scatter` needs to build the requests for it (say,
+the rows it covers)"""
+
+class CoordinatorResource(resource.Resource):
+    """Resource that fans PARALLELIZE requests out to the members of a
+    parallelism entity and replies once with their combined results.
+
+    The work is split into shares, typically the shards of a data set.
+    `members` is a function (or coroutine function) that returns, for every
+    share, the (address, port) pair of the member responsible for it, or None
+    if the share currently has none, or a :class:`Share` that also carries
+    data for :meth:`scatter`; it is called for every request, so membership
+    changes are picked up right away. Requests are sent to the `path` on
+    every member.
+
+    Shares can be replicated on several members, in which case every request
+    is sent to only one of them: the one with the fewest requests from this
+    coordinator in flight, and among those, the one with the lowest moving
+    average of its response times (see :meth:`get_load`). Failures count as
+    responses that took `failure_penalty` seconds. If that member fails, the
+    share is sent to the next one.
+
+    With a `policy` (see :class:`StragglerPolicy`), shares whose members are
+    slow or failed are sent to another member as well: to another replica
+    first, then to one of the members returned by the optional `standbys`
+    function (or coroutine function), then to the members of other shares.
+    Members that failed are not asked again while the same request is
+    processed. Without a policy, every share is only sent to its own
+    members.
+
+    `reducer` is called with the original request, the list of the shares'
+    responses and the list of the shares that are missing from them (as
+    described by :meth:`describe_missing`, by default their numbers), and
+    returns the response message. Members are asked for the reducer's
+    ``accept`` format, or else its ``content_format`` (if it has either), and
+    requests that accept only another format than its ``content_format`` are
+    answered with 4.06 Not Acceptable. If no member could respond
+    successfully for a share, the coordinator responds with 5.02 Bad Gateway.
+    Only timeouts, transport errors and server errors count as failures: a
+    client error response of a member is returned to the client as it is,
+    without asking any other member.
+
+    Requests for which :meth:`get_deadline` returns a time in seconds are
+    answered with a partial result when that time is up: the reducer gets the
+    responses that arrived until then, and shares that are still outstanding
+    or failed are missing. Requests to members that are still outstanding are
+    cancelled. If no share is complete by the deadline, the coordinator
+    responds with 5.04 Gateway Timeout.
+
+    Requests for which :meth:`get_work_stealing` returns True are instead
+    split into the many small chunks that :meth:`get_chunks` returns (by
+    default, the shares), which the members work through as if they pulled
+    them from a queue: every member is sent `pipeline` chunks at a time,
+    starting with those it is listed for, and another one whenever it
+    responds. A member that ran out of its own chunks takes over the last
+    ones of the member with the most chunks left, and once no chunk is left
+    to send, idle members duplicate the chunks that have been running for
+    the longest. That way, fast members do more of the work than slow ones
+    without any knowledge of their capacities, and a paused member holds up
+    the response by at most one chunk. The chunks of failed members go to
+    the others; the reducer gets the chunks' responses, and with a deadline,
+    chunks that did not complete in time are missing. Reducers that have a
+    ``start`` method (like :meth:`TopKReducer.start`) get every chunk's
+    response as soon as it arrives, so that only their merged result is
+    kept rather than all the responses; others get them in the order they
+    arrived.
+
+    The `context` used to send the requests may be set after construction
+    (typically to the server context the coordinator is served from), as long
+    as that happens before the first request arrives."""
+
+    def __init__(self, members, reducer, path, context=None, standbys=None, policy=None):
+        super().__init__()
+        self.members = members
+        self.reducer = reducer
+        self.path = tuple(path)
+        self.context = context
+        self.standbys = standbys
+        self.policy = policy
+
+        # requests in flight to, and moving average of the response times of
+        # every member
+        self._outstanding = collections.Counter()
+        self._latencies = {}
+
+    #: Default deadline for the whole request in seconds, see
+    #: :meth:`get_deadline`
+    deadline = None
+
+    #: Weight of every new response time in the moving average of a member
+    latency_smoothing = 0.2
+
+    #: Response time in seconds that a failure counts as
+    failure_penalty = 1.0
+
+    #: Default for :meth:`get_work_stealing`
+    work_stealing = False
+
+    #: Chunks that every member works on at a time in work stealing mode
+    pipeline = 1
+
+    def get_deadline(self, request):
+        """Time in seconds after which a partial result is returned for
+        `request`, or None to wait for all shares; override this to take the
+        deadline from the request."""
+        return self.deadline
+
+    @staticmethod
+    async def _call(function):
+        result = function()
+        if asyncio.iscoroutine(result):
+            result = await result
+        return list(result)
+
+    def get_work_stealing(self, request):
+        """Whether `request` is processed in chunks that the members steal
+        from each other; override this to let the request decide."""
+        return self.work_stealing
+
+    async def get_members(self):
+        """The shares of the next request, as :class:`Share` objects"""
+        return [share if isinstance(share, Share) else
+                Share([share] if share is not None else [], None)
+                for share in await self._call(self.members)]
+
+    async def get_chunks(self):
+        """The chunks of the next request in work stealing mode, as
+        :class:`Share` objects whose members are those that should get the
+        chunk first; by default, these are the shares"""
+        return await self.get_members()
+
+    async def get_standbys(self):
+        if self.standbys is None:
+            return []
+        return await self._call(self.standbys)
+
+    def describe_missing(self, shares, missing):
+        """How the shares (or chunks) out of `shares` whose numbers are listed
+        in `missing` are named to the reducer; override this to name them by
+        their data, as the numbers only refer to this request's list of
+        shares."""
+        return missing
+
+    def scatter(self, request, member, share):
+        """Build the request that is sent to `member` for the :class:`Share`
+        `share` of an incoming `request`; override this to send member or
+        share specific requests (which is needed for members to be able to
+        stand in for others)."""
+        address, port = member
+        outgoing = message.Message(code=request.code, payload=request.payload,
+                uri='coap://%s' % hostportjoin(address, port), uri_path=self.path)
+        outgoing.opt.content_format = request.opt.content_format
+        # the members' responses are for the reducer to read, whatever the
+        # client accepts
+        outgoing.opt.accept = getattr(self.reducer, 'accept',
+                getattr(self.reducer, 'content_format', request.opt.accept))
+        return outgoing
+
+    def get_load(self, member):
+        """Number of requests in flight to `member`, and the moving average
+        of its response times in seconds (0 while it is not known)"""
+        return self._outstanding[member], self._latencies.get(member, 0)
+
+    def _rank(self, members):
+        return sorted(members, key=self.get_load)
+
+    def _observe(self, member, latency):
+        average = self._latencies.get(member)
+        self._latencies[member] = latency if average is None else \
+                average + self.latency_smoothing * (latency - average)
+
+    def _done(self, member):
+        self._outstanding[member] -= 1
+        if not self._outstanding[member]:
+            del self._outstanding[member]
+
+    async def _request(self, member, outgoing, policy):
+        try:
+            # cancelling the response (here through wait_for) also cancels
+            # the request
+            response = await asyncio.wait_for(self.context.request(outgoing).response, policy.deadline)
+        except asyncio.TimeoutError:
+            raise MemberFailed("Member %s did not respond within %s seconds" % (member, policy.deadline))
+        except (error.Error, OSError) as e:
+            # OSError: ICMP errors like connection refused surface as such
+            raise MemberFailed("Member %s failed: %s" % (member, e)) from e
+        if response.code.class_ == 4:
+            raise MemberRejected(response)
+        if not response.code.is_successful():
+            raise MemberFailed("Member %s responded %s" % (member, response.code))
+        return response
+
+    @staticmethod
+    def _forward(response):
+        # a member's client error response, as the coordinator's response
+        return message.Message(code=response.code, payload=response.payload,
+                content_format=response.opt.content_format)
+
+    async def _gather_one(self, member, outgoing, policy):
+        started = time.monotonic()
+        try:
+            response = await self._request(member, outgoing, policy)
+        except MemberFailed:
+            self._observe(member, max(time.monotonic() - started, self.failure_penalty))
+            raise
+        latency = time.monotonic() - started
+        policy.record(latency)
+        self._observe(member, latency)
+        return response
+
+    def _send(self, request, member, share, policy):
+        # task for the response of `member` to its request for `share`
+        task = asyncio.ensure_future(self._gather_one(member,
+            self.scatter(request, member, share), policy))
+        # counted right away, so that the next share already sees the
+        # request when picking among its replicas
+        self._outstanding[member] += 1
+        task.add_done_callback(lambda task: self._done(member))
+        return task
+
+    async def _gather_share(self, request, number, share, fallbacks, failed):
+        """Response to the `number`-th `share` of `request`, asked from its
+        members and, as the policy demands, from the `fallbacks`"""
+        policy = self.policy if self.policy is not None else _NO_STRAGGLER_POLICY
+
+        running = {}
+        errors = []
+        sent = 0
+        # every replica may be tried, even beyond the policy's attempts
+        attempts = max(policy.attempts, len(share.members))
+        candidates = iter(self._rank(share.members) + fallbacks)
+
+        def send():
+            nonlocal sent
+            if sent >= attempts:
+                return
+            for candidate in candidates:
+                # skip members that failed for other shares in the meantime
+                if candidate not in failed:
+                    running[self._send(request, candidate, share, policy)] = candidate
+                    sent += 1
+                    return
+
+        send()
+        hedged = False
+        try:
+            while running:
+                done, pending = await asyncio.wait(running,
+                        timeout=None if hedged else policy.hedge_delay(),
+                        return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # the share is straggling: hedge it
+                    hedged = True
+                    send()
+                    continue
+
+                for task in done:
+                    candidate = running.pop(task)
+                    try:
+                        return task.result()
+                    except MemberFailed as e:
+                        failed.add(candidate)
+                        errors.append(str(e))
+
+                if not running:
+                    send()
+        finally:
+            for task in running:
+                task.cancel()
+
+        if not errors:
+            errors.append("No member available")
+        raise MemberFailed("Share %d failed: %s" % (number, "; ".join(errors)))
+
+    async def _render_work_stealing(self, request):
+        chunks = await self.get_chunks()
+        members = []
+        for member in [m for chunk in chunks for m in chunk.members] + await self.get_standbys():
+            if member not in members:
+                members.append(member)
+        if not chunks or not members:
+            return message.Message(code=numbers.codes.SERVICE_UNAVAILABLE,
+                    payload=b"No members to parallelize to")
+
+        policy = self.policy if self.policy is not None else _NO_STRAGGLER_POLICY
+        loop = asyncio.get_event_loop()
+        deadline = self.get_deadline(request)
+        end = loop.time() + deadline if deadline is not None else None
+
+        # the numbers of the chunks every member is to work on, replicated
+        # chunks going to the replica with the fewest so far; chunks without
+        # members go to whoever steals them first
+        queues = {member: collections.deque() for member in members}
+        for number, chunk in enumerate(chunks):
+            owners = chunk.members or members
+            queues[min(owners, key=lambda member: len(queues[member]))].append(number)
+
+        if hasattr(self.reducer, 'start'):
+            merge = self.reducer.start(request)
+        else:
+            merge = _CollectedResponses(self.reducer, request)
+        # numbers of the chunks whose response was merged
+        completed = set()
+        running = {}
+        # time every chunk was first sent, to duplicate the oldest first
+        started = {}
+        failed = set()
+        errors = []
+
+        def next_chunk(member):
+            if queues[member]:
+                return queues[member].popleft()
+            victim = max(queues, key=lambda member: len(queues[member]))
+            if queues[victim]:
+                return queues[victim].pop()
+            attempts = collections.Counter(number for (m, number) in running.values())
+            duplicates = [number for (m, number) in running.values()
+                    if attempts[number] == 1 and m != member]
+            return min(duplicates, key=started.get, default=None)
+
+        def feed(member):
+            while sum(1 for (m, number) in running.values() if m == member) < self.pipeline:
+                number = next_chunk(member)
+                if number is None:
+                    return
+                running[self._send(request, member, chunks[number], policy)] = (member, number)
+                started.setdefault(number, loop.time())
+
+        for member in members:
+            feed(member)
+        try:
+            while running:
+                timeout = end - loop.time() if end is not None else None
+                if timeout is not None and timeout <= 0:
+                    break
+                done, pending = await asyncio.wait(running, timeout=timeout,
+                        return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    if task not in running:
+                        # a duplicate of a chunk completed in the same batch
+                        continue
+                    member, number = running.pop(task)
+                    try:
+                        response = task.result()
+                    except MemberRejected as e:
+                        return self._forward(e.response)
+                    except MemberFailed as e:
+                        failed.add(member)
+                        errors.append(str(e))
+                        # the other members steal the failed member's chunks
+                        if number not in completed and number not in [n for (m, n) in running.values()]:
+                            queues[member].appendleft(number)
+                        continue
+
+                    if number not in completed:
+                        completed.add(number)
+                        merge.add(response)
+                    for other, (m, n) in list(running.items()):
+                        if n == number:
+                            other.cancel()
+                            del running[other]
+
+                for member in members:
+                    if member not in failed:
+                        feed(member)
+        finally:
+            for task in running:
+                task.cancel()
+
+        missing = [number for number in range(len(chunks)) if number not in completed]
+        if missing and deadline is None:
+            return message.Message(code=numbers.codes.BAD_GATEWAY,
+                    payload=("Chunks %s failed: %s" % (missing, "; ".join(errors) or
+                        "No member available")).encode('utf8'))
+        if not completed:
+            return message.Message(code=numbers.codes.GATEWAY_TIMEOUT,
+                    payload=b"No chunk completed within the deadline")
+
+        return merge.finish(self.describe_missing(chunks, missing))
+
+    async def render_parallelize(self, request):
+        content_format = getattr(self.reducer, 'content_format', None)
+        if None not in (request.opt.accept, content_format) and request.opt.accept != content_format:
+            return message.Message(code=numbers.codes.NOT_ACCEPTABLE)
+
+        if self.get_work_stealing(request):
+            return await self._render_work_stealing(request)
+
+        members = await self.get_members()
+        standbys = await self.get_standbys() if self.policy is not None else []
+        if not members:
+            return message.Message(code=numbers.codes.SERVICE_UNAVAILABLE,
+                    payload=b"No members to parallelize to")
+
+        # members that failed during this request, across all shares
+        failed = set()
+
+        def fallbacks(number):
+            # standbys first, then the members of the other shares; every
+            # share starts elsewhere in the standbys to spread the load
+            if self.policy is None:
+                return []
+            offset = number % len(standbys) if standbys else 0
+            others = []
+            for share in members[number + 1:] + members[:number]:
+                for member in share.members:
+                    if member not in others and member not in members[number].members:
+                        others.append(member)
+            return standbys[offset:] + standbys[:offset] + others
+
+        deadline = self.get_deadline(request)
+
+        shares = [asyncio.ensure_future(self._gather_share(request, number, share, fallbacks(number), failed))
+                for number, share in enumerate(members)]
+        try:
+            if deadline is None:
+                responses = await asyncio.gather(*shares)
+                missing = []
+            else:
+                await asyncio.wait(shares, timeout=deadline)
+                responses = []
+                missing = []
+                for task in shares:
+                    if task.done() and isinstance(task.exception(), MemberRejected):
+                        raise task.exception()
+                for number, task in enumerate(shares):
+                    if task.done() and task.exception() is None:
+                        responses.append(task.result())
+                    else:
+                        missing.append(number)
+                if not responses:
+                    return message.Message(code=numbers.codes.GATEWAY_TIMEOUT,
+                            payload=b"No share completed within the deadline")
+        except MemberRejected as e:
+            return self._forward(e.response)
+        except MemberFailed as e:
+            return message.Message(code=numbers.codes.BAD_GATEWAY,
+                    payload=str(e).encode('utf8'))
+        finally:
+            # this cancels the requests of shares that are still outstanding
+            for task in shares:
+                task.cancel()
+
+        return self.reducer(request, responses, self.describe_missing(members, missing))
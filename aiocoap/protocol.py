@@ -594,10 +594,20 @@ class Request(interfaces.Request, BaseUnicastRequest):
         else:
             self.observation = None
 
-        loop.create_task(self._run())
+        self._runner = loop.create_task(self._run())
+        self.response.add_done_callback(self._response_cancellation_handler)
 
         self.log = log
 
+    def _response_cancellation_handler(self, response_future):
+        # nobody is waiting for the response any more, so there is no need
+        # to keep the exchange (or an observation that never started) going
+        if response_future.cancelled():
+            self._runner.cancel()
+            self._plumbing_request.stop_interest()
+            if self.observation is not None and not self.observation.cancelled:
+                self.observation.error(error.ObservationCancelled())
+
     @staticmethod
     def _add_response_properties(response, request):
         response.request = request
@@ -607,6 +617,11 @@ class Request(interfaces.Request, BaseUnicastRequest):
 
         first_event = await self._plumbing_request._events.get()
 
+        if self.response.cancelled():
+            # cancelled while the response was already on its way in, before
+            # the cancellation handler got to run
+            return
+
         if first_event.message is not None:
             self._add_response_properties(first_event.message, self._plumbing_request.request)
             self.response.set_result(first_event.message)
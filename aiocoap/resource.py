@@ -25,8 +25,15 @@ Those take a single request message object and must return a
 
 To serve more than one resource on a site, use the :class:`Site` class to
 dispatch requests based on the Uri-Path header.
+
+Handlers that do blocking or CPU-heavy work can be plain functions decorated
+with :func:`blocking`; they are then run in an executor instead of stalling
+the whole server context.
 """
 
+import asyncio
+import concurrent.futures
+import functools
 import hashlib
 import warnings
 
@@ -70,6 +77,52 @@ def hashing_etag(request, response):
         response.code = numbers.codes.VALID
         response.payload = b''
 
+def blocking(method):
+    """Decorator for ``render_$method`` methods of a :class:`Resource` that
+    are regular functions which block or are CPU-heavy, rather than
+    coroutines.
+
+    The resource's :meth:`Resource.render` runs them in the resource's
+    ``executor`` (the event loop's default thread pool unless set), with at
+    most ``max_concurrency`` of them running at the same time; further
+    requests wait in a queue whose depth is reported by
+    :meth:`Resource.get_blocking_statistics`.
+
+    >>> from aiocoap import *
+    >>> class Sum(Resource):
+    ...     max_concurrency = 2
+    ...     @blocking
+    ...     def render_post(self, request):
+    ...         return Message(payload=str(sum(request.payload)).encode('ascii'))
+    >>> loop = asyncio.new_event_loop()
+    >>> response = loop.run_until_complete(Sum().render(Message(code=POST, payload=b'abc')))
+    >>> response.payload
+    b'294'
+    >>> loop.close()
+
+    With a process pool as ``executor``, the resource is pickled and sent to
+    the pool along with the request; the executor and the queue bookkeeping
+    are left behind, and so is the request's remote address. Everything else
+    the resource holds needs to be picklable then, and changes the method
+    makes to the resource stay in the pool process."""
+    method.blocking = True
+    return method
+
+def _run_blocking(resource, name, request):
+    # what an executor runs for a blocking render method; a plain function,
+    # so that it can be sent to process pools
+    return getattr(resource, name)(request)
+
+class _BlockingRenderState:
+    """Per-resource bookkeeping for running :func:`blocking` render methods"""
+
+    def __init__(self, max_concurrency):
+        self.semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.max_queued = 0
+
 class _ExposesWellknownAttributes:
     def get_link_description(self):
         ## FIXME which formats are acceptable, and how much escaping and
@@ -96,11 +149,23 @@ class Resource(_ExposesWellknownAttributes, interfaces.Resource):
     into the response (see :meth:`.interfaces.Resource.render`) if none was
     set.
 
+    Render methods decorated with :func:`blocking` are regular functions that
+    get run in the resource's :attr:`executor`, limited to
+    :attr:`max_concurrency` at a time.
+
     Moreover, this class provides a ``get_link_description`` method as used by
     .well-known/core to expose a resource's ``.ct``, ``.rt`` and ``.if_``
     (alternative name for ``if`` as that's a Python keyword) attributes.
     """
 
+    #: Executor that :func:`blocking` render methods are run in; None uses
+    #: the event loop's default executor.
+    executor = None
+
+    #: Number of :func:`blocking` render methods of this resource that may
+    #: run at the same time; None does not limit them.
+    max_concurrency = None
+
     async def needs_blockwise_assembly(self, request):
         return True
 
@@ -111,7 +176,10 @@ class Resource(_ExposesWellknownAttributes, interfaces.Resource):
         if not m:
             raise error.UnallowedMethod()
 
-        response = await m(request)
+        if getattr(m, 'blocking', False):
+            response = await self._render_blocking(m, request)
+        else:
+            response = await m(request)
 
         if response is message.NoResponse:
             warnings.warn("Returning NoResponse is deprecated, please return a"
@@ -133,11 +201,66 @@ class Resource(_ExposesWellknownAttributes, interfaces.Resource):
 
         return response
 
+    def __getstate__(self):
+        # leave the loop-side state behind when the resource is sent to a
+        # process pool for a blocking render method
+        state = self.__dict__.copy()
+        state.pop('_Resource__blocking_state', None)
+        state.pop('executor', None)
+        return state
+
+    def _blocking_state(self):
+        try:
+            return self.__blocking_state
+        except AttributeError:
+            self.__blocking_state = _BlockingRenderState(self.max_concurrency)
+            return self.__blocking_state
+
+    async def _render_blocking(self, m, request):
+        state = self._blocking_state()
+        loop = asyncio.get_event_loop()
+
+        state.queued += 1
+        state.max_queued = max(state.max_queued, state.queued)
+        try:
+            if state.semaphore is not None:
+                await state.semaphore.acquire()
+        finally:
+            state.queued -= 1
+
+        if isinstance(self.executor, concurrent.futures.ProcessPoolExecutor):
+            # the remote is bound to the transport it came in on
+            request = request.copy(remote=None)
+
+        state.running += 1
+        try:
+            return await loop.run_in_executor(self.executor,
+                    functools.partial(_run_blocking, self, m.__name__, request))
+        finally:
+            state.running -= 1
+            state.completed += 1
+            if state.semaphore is not None:
+                state.semaphore.release()
+
+    def get_blocking_statistics(self):
+        """Return the number of :func:`blocking` renderings of this resource
+        that are currently waiting for their turn (``queued``), ``running``
+        and ``completed``, along with the deepest the queue ever was
+        (``max_queued``)"""
+        state = self._blocking_state()
+        return {"queued": state.queued, "running": state.running,
+                "completed": state.completed, "max_queued": state.max_queued}
+
 class ObservableResource(Resource, interfaces.ObservableResource):
     def __init__(self):
         super(ObservableResource, self).__init__()
         self._observations = set()
 
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop('_observations', None)
+        return state
+
     async def add_observation(self, request, serverobservation):
         self._observations.add(serverobservation)
         def _cancel(self=self, obs=serverobservation):
@@ -410,52 +533,88 @@ class Site(interfaces.ObservableResource, PathCapable):
                     links.append(Link('/' + '/'.join(path) + l.href, l.attr_pairs))
         return LinkFormat(links)
 
-    # designate this resource as a parallelism directory
-    def set_up_as_parallelism_directory(self):
+    # designate this resource as a parallelism directory; with a journal
+    # (see parallelism.Journal), the entities and their members are restored
+    # from it, and every change is recorded in it
+    def set_up_as_parallelism_directory(self, journal=None):
+        self._parallelism_journal = journal
         self._parallelism_index = 0
+        # index of the directory in both directions: the set of members of
+        # every entity id, and the set of entity ids of every member
         self._parallelism_entities = {}
-
-    # add member to parallelism entity with id entity
-    def add_parallelism_entity_member(self, entity, member):
+        self._parallelism_memberships = {}
+
+        if journal is not None:
+            self._parallelism_index = journal.get(("parallelism-index",), 0)
+            for (kind, entity), value in journal.items(("parallelism-entity",)):
+                self._parallelism_entities[entity] = set()
+            for (kind, entity, member), value in journal.items(("parallelism-member",)):
+                self._parallelism_entities[entity].add(member)
+                self._parallelism_memberships.setdefault(member, set()).add(entity)
+
+    def _parallelism_journal_put(self, *key):
+        if self._parallelism_journal is not None:
+            self._parallelism_journal.put(key, True)
+
+    def _parallelism_journal_delete(self, *key):
+        if self._parallelism_journal is not None:
+            self._parallelism_journal.delete(key)
+
+    # normalize an entity id (ints and their string forms are the same id),
+    # and check that it exists
+    def _parallelism_entity_key(self, entity):
         entity = str(entity)
         if entity not in self._parallelism_entities:
             raise KeyError("{} is not a parallelism entity key".format(entity))
+        return entity
+
+    # add member to parallelism entity with id entity
+    def add_parallelism_entity_member(self, entity, member):
+        entity = self._parallelism_entity_key(entity)
 
         self._parallelism_entities[entity].add(member)
+        self._parallelism_memberships.setdefault(member, set()).add(entity)
+        self._parallelism_journal_put("parallelism-member", entity, member)
 
     # remove member from parallelism entity with key entity
     def remove_parallelism_entity_member(self, entity, member):
-        entity = str(entity)
-        if entity not in self._parallelism_entities:
-            raise KeyError("{} is not a parallelism entity key".format(entity))
+        entity = self._parallelism_entity_key(entity)
 
         if member not in self._parallelism_entities[entity]:
             raise ValueError("{} is not a member of parallelism entity {}".format(member, entity))
 
         self._parallelism_entities[entity].remove(member)
+        memberships = self._parallelism_memberships[member]
+        memberships.remove(entity)
+        if not memberships:
+            del self._parallelism_memberships[member]
+        self._parallelism_journal_delete("parallelism-member", entity, member)
 
     # return all parallelism entity ids that member is part of
     def find_parallelism_entities_for_member(self, member):
-        return [entity for entity in self._parallelism_entities if member in entity]
+        return list(self._parallelism_memberships.get(member, ()))
 
     # remove member from all associated parallelism entities
     def shut_down_parallelism_entity_member(self, member):
-        for entity in self._parallelism_entities:
-            if member in entity:
-                entity.remove(member)
+        for entity in self._parallelism_memberships.pop(member, ()):
+            self._parallelism_entities[entity].remove(member)
+            self._parallelism_journal_delete("parallelism-member", entity, member)
 
-    # create a new paralleism entity starting with member
+    # create a new paralleism entity starting with member; ids are never
+    # reused
     def create_parallelism_entity(self, member):
-        self._parallelism_entities[str(self._parallelism_index)] = set()
-        self._parallelism_entities[str(self._parallelism_index)].add(member)
+        entity = str(self._parallelism_index)
         self._parallelism_index += 1
-        return self._parallelism_index - 1
+
+        self._parallelism_entities[entity] = set()
+        if self._parallelism_journal is not None:
+            self._parallelism_journal.put(("parallelism-index",), self._parallelism_index)
+        self._parallelism_journal_put("parallelism-entity", entity)
+        self.add_parallelism_entity_member(entity, member)
+        return int(entity)
 
     def all_parallelism_entities(self):
         return self._parallelism_entities
 
     def get_parallelism_entity_by_id(self, entity):
-        entity = str(entity)
-        if entity not in self._parallelism_entities:
-            raise KeyError("{} is not a parallelism entity key".format(entity))
-        return self._parallelism_entities[entity]
+        return self._parallelism_entities[self._parallelism_entity_key(entity)]
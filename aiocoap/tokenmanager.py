@@ -261,7 +261,8 @@ class PlumbingRequest:
         self._interest.add_done_callback(handle_interest_end)
 
     def stop_interest(self):
-        self._interest.set_result(None)
+        if not self._interest.done():
+            self._interest.set_result(None)
 
     def poke(self):
         """Ask the responder for a life sign. It is up to the responder to
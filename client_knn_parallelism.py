@@ -15,7 +15,12 @@ for some more information."""
 import logging
 import asyncio
 from aiocoap import *
+from aiocoap import error
+from aiocoap.numbers import media_types_rev
+from aiocoap.parallelism import top_k_as_completed
 import json
+import struct
+import sys
 import time
 
 
@@ -23,43 +28,161 @@ logging.basicConfig(level=logging.INFO)
 
 num_recs = 5
 
-async def schedule_knn(address, port, protocol, index, length, res):
+# one of euclidean, cosine or pearson
+metric = 'euclidean'
+
+# exact, or approx to only scan the most promising clusters of every shard
+mode = 'exact'
+
+# number of recommendation requests to send; all but the first find the
+# workers through the observed membership without asking the directory again
+runs = 1
+
+# milliseconds after which the coordinator returns what it has, or None to
+# wait for all shards
+deadline = None
+
+# have the coordinator hand out the partitions one by one to whichever
+# worker is done with its previous one, rather than all at once
+steal = False
+
+class MembershipView:
+    """Locally cached shard map of the parallelism entity, which is kept up
+    to date by observing the directory's parallelism-entity resource"""
+
+    def __init__(self, protocol, uri):
+        self.protocol = protocol
+        self.uri = uri
+        self.shard_map = None
+        self.observation = None
+
+    async def start(self):
+        request = self.protocol.request(Message(code=GET, uri=self.uri, observe=0))
+        self._update(await request.response)
+
+        self.observation = request.observation
+        if self.observation is not None:
+            self.observation.register_callback(self._update)
+            self.observation.register_errback(self._failed)
+
+    def _update(self, response):
+        self.shard_map = json.loads(response.payload.decode('ascii'))
+        logging.info("Membership changed: %s", self.shard_map)
+
+    def _failed(self, exception):
+        # keep working with the last known membership
+        logging.warning("Observation of membership ended: %s", exception)
+
+    def stop(self):
+        if self.observation is not None:
+            self.observation.cancel()
+
+async def schedule_knn(address, port, protocol, rows):
     # create request
-    body = {'num_recs': num_recs, 'movie_title': 'Pocahontas (1995)', 'index': index, 'length': length}
+    body = {'num_recs': num_recs, 'movie_title': 'Pocahontas (1995)', 'metric': metric, 'mode': mode, 'rows': rows}
     payload = json.dumps(body).encode('ascii')
-    request = Message(code=PARALLELIZE, payload=payload, uri='coap://{}:{}/knn'.format(address, port))
+    request = Message(code=PARALLELIZE, payload=payload, uri='coap://{}:{}/knn'.format(address, port),
+            accept=media_types_rev['application/octet-stream'])
 
     # send request to parallelism worker
     response = await protocol.request(request).response
-    movies = json.loads(response.payload.decode('ascii'))
+    if not response.code.is_successful():
+        raise error.Error("Worker %s:%s failed: %s %s" % (address, port, response.code,
+            response.payload.decode('utf8', 'replace')))
+
+    # top movie results of the worker's partitions; the packed response holds (int32
+    # movieId, float32 distance) records
+    return struct.iter_unpack('<if', response.payload)
+
+async def resolve_titles(address, port, protocol, movies):
+    # look up the titles of the final recommendations in one request
+    query = ['id={}'.format(movie_id) for movie_id, dist in movies]
+    request = Message(code=GET, uri='coap://{}:{}/knn/titles'.format(address, port), uri_query=query)
+    response = await protocol.request(request).response
+    if not response.code.is_successful():
+        raise error.Error("Title lookup failed: %s" % response.code)
+    titles = json.loads(response.payload.decode('ascii'))
 
-    # concatenate top movie result from shard to result list
-    res += movies
+    return [(str(movie_id), titles.get(str(movie_id)), str(dist)) for movie_id, dist in movies]
 
 async def main():
     protocol = await Context.create_client_context()
 
     start = time.time()
 
-    # get active worker nodes
-    request = Message(code=GET, uri='coap://127.0.0.1:5000/parallelism-entity')
-    response = await protocol.request(request).response
-    entity = json.loads(response.payload.decode('ascii'))
+    if '--coordinator' in sys.argv:
+        # let the directory fan the request out to the workers and merge
+        # their results
+        body = {'num_recs': num_recs, 'movie_title': 'Pocahontas (1995)', 'metric': metric, 'mode': mode}
+        if deadline is not None:
+            body['deadline'] = deadline
+        if steal:
+            body['steal'] = True
+        request = Message(code=PARALLELIZE, payload=json.dumps(body).encode('ascii'),
+                uri='coap://127.0.0.1:5000/knn')
+        response = await protocol.request(request).response
+        if not response.code.is_successful():
+            print("REQUEST FAILED: ", response.code, response.payload.decode('utf8'))
+            return
+        recommendations = json.loads(response.payload.decode('ascii'))
+
+        # partial results name the rows of the partitions that did not make
+        # the deadline
+        if isinstance(recommendations, dict):
+            print("MISSING ROWS: ", recommendations["missing"])
+            recommendations = recommendations["results"]
+        print("YOUR RECOMMENDATIONS: ", recommendations)
+        print('TIME ELAPSED: {} seconds'.format(time.time() - start))
+        return
+
+    # keep track of the active worker nodes along with the partitions each of
+    # them owns
+    view = MembershipView(protocol, 'coap://127.0.0.1:5000/parallelism-entity')
+    await view.start()
+
+    for run in range(runs):
+        await recommend(protocol, view.shard_map)
+
+    view.stop()
+
+async def recommend(protocol, shard_map):
+    start = time.time()
 
-    # result list for shard results
+    if not shard_map["members"] or shard_map["ranges"] is None:
+        # no workers, or none told the size of the data set yet: there is
+        # nothing to search
+        print("YOUR RECOMMENDATIONS: ", [])
+        print('TIME ELAPSED: {} seconds'.format(time.time() - start))
+        return
+
+    # schedule knn requests on worker nodes for the rows of their partitions
+    # (spares own none); every partition is only asked from one of its
+    # replicas, the one with the fewest partitions to search so far
+    rows = [[] for member in shard_map["members"]]
+    for index, owners in enumerate(shard_map["owners"]):
+        owner = min(owners, key=lambda owner: len(rows[owner]))
+        rows[owner].append(shard_map["ranges"][index])
+    requests = [
+        schedule_knn(address, port, protocol, member_rows)
+        for (address, port), member_rows in zip(shard_map["members"], rows)
+        if member_rows
+    ]
+
+    # merge the shard results into the closest movies as they come in; if a
+    # worker fails, the requests to the others are cancelled
     res = []
-
-    # schedule knn requests on worker nodes
-    await asyncio.gather(*[
-        schedule_knn(address, port, protocol, i, len(entity), res)
-        for i, (address, port) in enumerate(entity)
-    ])
-
-    # sort movie distances in ascending order
-    res.sort(key=lambda x: float(x[2]))
-
-    # return top 5 movie recommendations
-    print("YOUR RECOMMENDATIONS: ", res[:num_recs])
+    try:
+        async with top_k_as_completed(requests, num_recs, key=lambda x: x[1]) as completed:
+            async for res in completed:
+                logging.debug("Best so far after %.3f seconds: %s", time.time() - start, res)
+
+        # return top 5 movie recommendations
+        address, port = shard_map["members"][0]
+        recommendations = await resolve_titles(address, port, protocol, res)
+    except error.Error as e:
+        print("REQUEST FAILED: ", e)
+        return
+    print("YOUR RECOMMENDATIONS: ", recommendations)
 
     # measure computation speed
     print('TIME ELAPSED: {} seconds'.format(time.time() - start))
@@ -0,0 +1,82 @@
+# This file is part of the Python aiocoap library project.
+#
+# Copyright (c) 2012-2014 Maciej Wasilak <http://sixpinetrees.blogspot.com/>,
+#               2013-2014 Christian Amsüss <c.amsuess@energyharvesting.at>
+#
+# aiocoap is free software, this file is published under the MIT license as
+# described in the accompanying LICENSE file.
+
+"""Approximate nearest neighbour index for the KNN parallelism example.
+
+The :class:`IVFIndex` clusters the rows of a worker's shard around a few
+centroids (a small k-means run). An approximate query then only scans the rows
+of the clusters whose centroids are closest to the query movie, trading recall
+for latency through the number of clusters probed."""
+
+import numpy as np
+
+class IVFIndex:
+    """Inverted file index over the rows of a dense or CSR matrix
+
+    `lists` is the number of clusters (by default about the square root of the
+    number of rows); `iterations` bounds the k-means refinement."""
+
+    def __init__(self, data, sq_norms, lists=None, iterations=10, seed=0):
+        rows = data.shape[0]
+        if lists is None:
+            lists = int(np.sqrt(rows))
+        lists = max(1, min(lists, rows))
+
+        # start from randomly picked rows, then refine with k-means
+        rng = np.random.default_rng(seed)
+        centroids = self._dense(data[np.sort(rng.choice(rows, lists, replace=False))]) if rows else \
+                np.zeros((lists, data.shape[1]), dtype=np.float32)
+        assignment = np.zeros(rows, dtype=np.intp)
+
+        for i in range(iterations if rows else 0):
+            assignment = self._nearest_centroids(data, sq_norms, centroids)
+
+            # centroids are the means of their members; empty clusters keep
+            # their previous centroid
+            onehot = (assignment == np.arange(lists)[:, None]).astype(np.float32)
+            counts = onehot.sum(axis=1)
+            sums = np.asarray(data.T @ onehot.T).T
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+
+        self.centroids = centroids
+        self.centroid_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+
+        # shard rows of every cluster, in ascending order
+        order = np.argsort(assignment, kind='stable')
+        bounds = np.searchsorted(assignment[order], np.arange(lists + 1))
+        self.lists = [order[bounds[c]:bounds[c + 1]] for c in range(lists)]
+
+    @staticmethod
+    def _dense(rows):
+        return rows.toarray() if hasattr(rows, 'toarray') else np.array(rows, dtype=np.float32)
+
+    def _nearest_centroids(self, data, sq_norms, centroids):
+        centroid_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+        sq_dists = sq_norms[:, None] + centroid_sq_norms[None, :] - 2 * np.asarray(data @ centroids.T)
+        return np.argmin(sq_dists, axis=1)
+
+    @property
+    def default_probes(self):
+        return max(1, len(self.lists) // 4)
+
+    def candidates(self, query, probes=None):
+        """Shard rows in the `probes` clusters closest to the dense `query`
+        vector, in ascending order"""
+        if probes is None:
+            probes = self.default_probes
+        probes = max(1, min(probes, len(self.lists)))
+
+        # the query's own norm is the same for all centroids and can be left out
+        sq_dists = self.centroid_sq_norms - 2 * (self.centroids @ query)
+        if probes < len(self.lists):
+            closest = np.argpartition(sq_dists, probes - 1)[:probes]
+        else:
+            closest = np.arange(len(self.lists))
+
+        return np.sort(np.concatenate([self.lists[c] for c in closest]))
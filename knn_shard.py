@@ -0,0 +1,227 @@
+# This file is part of the Python aiocoap library project.
+#
+# Copyright (c) 2012-2014 Maciej Wasilak <http://sixpinetrees.blogspot.com/>,
+#               2013-2014 Christian Amsüss <c.amsuess@energyharvesting.at>
+#
+# aiocoap is free software, this file is published under the MIT license as
+# described in the accompanying LICENSE file.
+
+"""Nearest neighbour search over one shard of the KNN parallelism example.
+
+A :class:`Shard` holds a worker's rows of the rating matrix together with
+everything derived from them (per-row statistics, the approximate index), and
+answers queries given as the query movies' rating vectors. It does not need
+the rest of the snapshot, which allows it to be moved into separate processes:
+:meth:`Shard.share` copies its arrays into shared memory, and the
+:func:`attach` initializer of a process pool rebuilds the shard there on top of
+the very same memory. A pool can serve several shards that way, and the
+results of several shards are combined with :func:`merge`."""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import knn_index
+
+class Shard:
+    """Rows ``[start:start + len(data))`` of a (dense or CSR) rating matrix
+    along with their squared norms.
+
+    Queries can pick any of the `metrics` to rank movies by. All of them are
+    derived from the same product of the shard with the query movies' rows,
+    and from per-row statistics that are computed once when the shard is
+    created; similarities are reported as distances (1 - similarity) so that
+    smaller always means closer.
+
+    Queries in ``approx`` mode only scan the rows in the `probes` clusters of
+    the shard's :class:`knn_index.IVFIndex` that lie closest to the query
+    movie; more probes give better recall at higher latency."""
+
+    metrics = ('euclidean', 'cosine', 'pearson')
+    modes = ('exact', 'approx')
+
+    def __init__(self, data, sq_norms, start, stats=None, index=None):
+        # contiguous float32 rows (or CSR rows) so that a whole shard can be
+        # handed to BLAS in one go, along with their squared norms
+        self.data = data
+        self.sq_norms = sq_norms
+        self.start = start
+        self.end = start + data.shape[0]
+
+        # per-row normalization for cosine and pearson: row norms, and the
+        # row means and standard deviations over all users
+        if stats is None:
+            users = data.shape[1]
+            norms = np.sqrt(sq_norms)
+            means = np.asarray(data.sum(axis=1), dtype=np.float32).ravel() / users
+            stds = np.sqrt(np.maximum(sq_norms / users - means ** 2, 0))
+            stats = (norms, means, stds)
+        self.norms, self.means, self.stds = stats
+
+        # clustering of the shard's rows for approximate queries, built on
+        # first use
+        self._index = index
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = knn_index.IVFIndex(self.data, self.sq_norms)
+        return self._index
+
+    def _distances(self, query_sq_norms, queries, metric, rows=slice(None)):
+        """Distances from the query movies (whose vectors are the rows of
+        `queries`) to the given `rows` of the shard (by default all of them)
+        by the given metric, as one column per query, computed from a single
+        batched product"""
+        dots = np.asarray(self.data[rows] @ queries.T)
+
+        return getattr(self, '_%s_distances' % metric)(dots, rows, query_sq_norms, queries)
+
+    def _euclidean_distances(self, dots, rows, query_sq_norms, queries):
+        # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b
+        sq_dists = self.sq_norms[rows, None] + query_sq_norms - 2 * dots
+
+        # cancellation can leave tiny negative values for (near) duplicates
+        np.maximum(sq_dists, 0, out=sq_dists)
+        return np.sqrt(sq_dists)
+
+    def _cosine_distances(self, dots, rows, query_sq_norms, queries):
+        # a.b / (||a|| ||b||), with rows without any ratings similar to nothing
+        denominators = self.norms[rows, None] * np.sqrt(query_sq_norms)
+        return 1 - self._similarities(dots, denominators)
+
+    def _pearson_distances(self, dots, rows, query_sq_norms, queries):
+        # cov(a, b) / (std(a) std(b)), where cov(a, b) = a.b / n - mean(a) mean(b)
+        users = queries.shape[1]
+        query_means = queries.sum(axis=1) / users
+        query_stds = np.sqrt(np.maximum(query_sq_norms / users - query_means ** 2, 0))
+        covariances = dots / users - self.means[rows, None] * query_means
+        return 1 - self._similarities(covariances, self.stds[rows, None] * query_stds)
+
+    @staticmethod
+    def _similarities(numerators, denominators):
+        return np.divide(numerators, denominators,
+                out=np.zeros_like(numerators, dtype=np.float32), where=denominators > 0)
+
+    @staticmethod
+    def _top_k(dists, k):
+        """Indices of the `k` smallest entries of `dists` in ascending order,
+        partitioning first so that only those `k` entries get sorted"""
+        if k <= 0:
+            return np.empty(0, dtype=np.intp)
+        if k < len(dists):
+            nearest = np.argpartition(dists, k - 1)[:k]
+        else:
+            nearest = np.arange(len(dists))
+        return nearest[np.argsort(dists[nearest], kind='stable')]
+
+    def _select(self, row, dists, positions, num_recs):
+        # skip over input movie
+        is_input = positions == row
+        dists[is_input] = np.inf
+        candidates = len(dists) - np.count_nonzero(is_input)
+
+        # select the num_recs closest movies of this shard
+        nearest = self._top_k(dists, min(num_recs, candidates))
+        return positions[nearest], dists[nearest]
+
+    def nearest(self, query_rows, queries, query_sq_norms, num_recs, metric='euclidean', mode='exact', probes=None):
+        """For each of the movies in the snapshot rows `query_rows` (whose
+        dense vectors are the rows of `queries`, and whose squared norms are
+        `query_sq_norms`), the snapshot rows of the `num_recs` movies of the
+        shard closest to it along with their distances"""
+        positions = np.arange(self.start, self.end)
+
+        if mode == 'approx':
+            # every query scans different rows, so they can't share a product
+            results = []
+            for i, row in enumerate(query_rows):
+                rows = self.index.candidates(queries[i], probes)
+                dists = self._distances(query_sq_norms[i:i + 1], queries[i:i + 1], metric, rows)
+                results.append(self._select(row, dists[:, 0], positions[rows], num_recs))
+            return results
+
+        # find distances for all movies in this shard, for all queries at once
+        dists = self._distances(query_sq_norms, queries, metric)
+        return [self._select(row, np.ascontiguousarray(dists[:, i]), positions, num_recs)
+                for i, row in enumerate(query_rows)]
+
+    def share(self):
+        """Copy the shard's arrays into shared memory.
+
+        Returns the shared memory blocks, which the caller needs to close and
+        unlink once the shard is not used any more, and a picklable
+        description of the shard from which :func:`attach` rebuilds it."""
+        sparse = hasattr(self.data, 'indptr')
+        arrays = {"sq_norms": self.sq_norms, "norms": self.norms, "means": self.means, "stds": self.stds}
+        if sparse:
+            arrays.update(data=self.data.data, indices=self.data.indices, indptr=self.data.indptr)
+        else:
+            arrays["data"] = self.data
+
+        blocks = []
+        layout = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            # zero-sized blocks are not allowed
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+            blocks.append(block)
+            layout[name] = (block.name, array.shape, array.dtype.str)
+
+        # an index that was not built yet is built by every process on first
+        # use rather than holding up the caller
+        description = {"layout": layout, "shape": self.data.shape, "sparse": sparse,
+                "start": self.start, "index": self._index}
+        return blocks, description
+
+    @classmethod
+    def from_shared(cls, description):
+        """Rebuild a shard shared through :meth:`share`; returns it and the
+        shared memory blocks it is built on"""
+        blocks = []
+        arrays = {}
+        for name, (block_name, shape, dtype) in description["layout"].items():
+            block = shared_memory.SharedMemory(name=block_name)
+            blocks.append(block)
+            arrays[name] = np.ndarray(shape, dtype, buffer=block.buf)
+
+        if description["sparse"]:
+            from scipy import sparse as sp
+
+            data = sp.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]),
+                    shape=description["shape"], copy=False)
+        else:
+            data = arrays["data"]
+
+        shard = cls(data, arrays["sq_norms"], description["start"],
+                (arrays["norms"], arrays["means"], arrays["stds"]), description["index"])
+        return shard, blocks
+
+def merge(results, num_recs):
+    """Merge the (snapshot rows, distances) results of several shards for
+    one query into the `num_recs` closest movies among them"""
+    if not results:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+    positions = np.concatenate([result[0] for result in results])
+    dists = np.concatenate([result[1] for result in results])
+    nearest = Shard._top_k(dists, min(num_recs, len(dists)))
+    return positions[nearest], dists[nearest]
+
+# the shards of a pool process by their (start, end) rows, and the shared
+# memory blocks they live in
+_shards = {}
+_blocks = []
+
+def attach(descriptions):
+    """Process pool initializer that makes :func:`nearest` work on the shards
+    shared through :meth:`Shard.share`"""
+    for description in descriptions:
+        shard, blocks = Shard.from_shared(description)
+        _shards[shard.start, shard.end] = shard
+        _blocks.extend(blocks)
+
+def nearest(rows, *args):
+    """:meth:`Shard.nearest` of the pool process's shard of the given
+    (start, end) `rows`"""
+    return _shards[rows].nearest(*args)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# This file is part of the Python aiocoap library project.
+#
+# Copyright (c) 2012-2014 Maciej Wasilak <http://sixpinetrees.blogspot.com/>,
+#               2013-2014 Christian Amsüss <c.amsuess@energyharvesting.at>
+#
+# aiocoap is free software, this file is published under the MIT license as
+# described in the accompanying LICENSE file.
+
+"""Preprocessing step for the KNN parallelism example.
+
+This reads the MovieLens CSV files once, drops unpopular movies and inactive
+users, and stores the resulting movie vs user matrix as a binary snapshot of
+plain ``.npy`` files. Workers then map that snapshot into memory instead of
+parsing and pivoting the CSV files on every start.
+
+Snapshots live in a directory named after a hash of the source CSV files, so a
+changed data set never gets confused with an old snapshot; the ``LATEST`` file
+next to them names the snapshot workers should load.
+
+Snapshots are either dense (a plain float32 matrix) or, with ``--sparse``, in
+CSR layout (``scipy.sparse``), which is an order of magnitude smaller for
+rating data and is needed to serve the full-size MovieLens data set."""
+
+import hashlib
+import os
+import shutil
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+MOVIES_CSV = "data/movies-small.csv"
+RATINGS_CSV = "data/ratings-small.csv"
+SNAPSHOT_DIR = "data/snapshots"
+
+# bump this whenever the layout of the snapshot files changes
+FORMAT_VERSION = 1
+
+# minimum number of ratings for a movie (a user) to be considered
+MIN_MOVIE_RATINGS = 50
+MIN_USER_RATINGS = 50
+
+Snapshot = namedtuple("Snapshot", ["version", "data", "sq_norms", "movie_ids", "user_ids", "titles"])
+Snapshot.__doc__ = """Movie vs user rating matrix (one float32 row per movie,
+dense or as a CSR matrix) along with the squared row norms, the movieId of
+every row, the userId of every column and the title of every row's movie"""
+
+_ARRAYS = ("sq_norms", "movie_ids", "user_ids", "titles")
+_SPARSE_ARRAYS = ("csr_data", "csr_indices", "csr_indptr")
+
+def source_version(paths=(MOVIES_CSV, RATINGS_CSV), sparse=False):
+    """Version identifier of a snapshot built from the given source files"""
+    digest = hashlib.sha256(b"knn-snapshot-%d-%s" % (FORMAT_VERSION, b"csr" if sparse else b"dense"))
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+def snapshot_path(version, directory=SNAPSHOT_DIR):
+    return os.path.join(directory, "knn-%s" % version)
+
+def build_pivot(movies_csv=MOVIES_CSV, ratings_csv=RATINGS_CSV, sparse=False):
+    """Read the CSV files and build the contents of a snapshot (with the
+    version left empty)"""
+    import pandas as pd
+
+    # import movie data
+    movie_data = pd.read_csv(movies_csv,
+        usecols=['movieId', 'title'],
+        dtype={'movieId': 'int32', 'title': 'str'})
+
+    # import corresponding ratings
+    rating_data = pd.read_csv(ratings_csv,
+        usecols=['userId', 'movieId', 'rating'],
+        dtype={'userId': 'int32', 'movieId': 'int32', 'rating': 'float32'})
+
+    # determine least popular movies and drop
+    movies_count = rating_data.groupby('movieId').size()
+    popular_movie_ids = movies_count[movies_count >= MIN_MOVIE_RATINGS].index
+    ratings_drop_movies = rating_data[rating_data.movieId.isin(popular_movie_ids)]
+
+    # determine least active users and drop
+    ratings_count = rating_data.groupby('userId').size()
+    active_user_ids = ratings_count[ratings_count >= MIN_USER_RATINGS].index
+    ratings_drop_movies_users = ratings_drop_movies[ratings_drop_movies.userId.isin(active_user_ids)]
+
+    if sparse:
+        # create the movie vs user matrix straight from the (movie, user)
+        # coordinates, never materializing the zeros
+        from scipy import sparse as sp
+
+        movie_ids, rows = np.unique(ratings_drop_movies_users.movieId.to_numpy(), return_inverse=True)
+        user_ids, columns = np.unique(ratings_drop_movies_users.userId.to_numpy(), return_inverse=True)
+        data = sp.csr_matrix((ratings_drop_movies_users.rating.to_numpy(dtype=np.float32), (rows, columns)),
+                shape=(len(movie_ids), len(user_ids)), dtype=np.float32)
+        data.sort_indices()
+
+        # squared row norms, so that distances reduce to one matrix-vector
+        # product: ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b
+        sq_norms = np.asarray(data.multiply(data).sum(axis=1), dtype=np.float32).ravel()
+    else:
+        # create movie vs user matrix for KNN computations
+        pivot = ratings_drop_movies_users.pivot(index='movieId', columns='userId', values='rating').fillna(0)
+
+        data = np.ascontiguousarray(pivot.to_numpy(dtype=np.float32))
+        movie_ids = pivot.index.to_numpy()
+        user_ids = pivot.columns.to_numpy()
+
+        # squared row norms, as above
+        sq_norms = np.einsum('ij,ij->i', data, data)
+
+    movie_ids = movie_ids.astype(np.int32)
+    user_ids = user_ids.astype(np.int32)
+    titles = movie_data.set_index('movieId')['title'].reindex(movie_ids).fillna('').to_numpy(dtype=str)
+
+    return Snapshot(None, data, sq_norms, movie_ids, user_ids, titles)
+
+def write_snapshot(movies_csv=MOVIES_CSV, ratings_csv=RATINGS_CSV, directory=SNAPSHOT_DIR, sparse=False):
+    """Build a snapshot from the CSV files unless one for their current
+    contents exists, mark it as the latest one, and return its version"""
+    version = source_version((movies_csv, ratings_csv), sparse)
+    path = snapshot_path(version, directory)
+
+    if not os.path.isdir(path):
+        snapshot = build_pivot(movies_csv, ratings_csv, sparse)
+
+        arrays = {name: getattr(snapshot, name) for name in _ARRAYS}
+        if sparse:
+            arrays.update(zip(_SPARSE_ARRAYS,
+                (snapshot.data.data, snapshot.data.indices, snapshot.data.indptr)))
+        else:
+            arrays["data"] = snapshot.data
+
+        # write into a scratch directory first, so that workers never see a
+        # half-written snapshot
+        scratch = path + ".tmp-%d" % os.getpid()
+        os.makedirs(scratch)
+        for name, array in arrays.items():
+            np.save(os.path.join(scratch, name + ".npy"), array)
+        try:
+            os.rename(scratch, path)
+        except OSError:
+            # another process wrote the same snapshot in the meantime
+            if not os.path.isdir(path):
+                raise
+            shutil.rmtree(scratch)
+
+    latest = os.path.join(directory, "LATEST")
+    latest_scratch = latest + ".tmp-%d" % os.getpid()
+    with open(latest_scratch, "w") as f:
+        f.write(version + "\n")
+    os.replace(latest_scratch, latest)
+
+    return version
+
+def latest_version(directory=SNAPSHOT_DIR):
+    """Version named in the snapshot directory's LATEST file; raises
+    FileNotFoundError if no snapshot was written yet"""
+    with open(os.path.join(directory, "LATEST")) as f:
+        return f.read().strip()
+
+def load_snapshot(version=None, directory=SNAPSHOT_DIR, mmap_mode='r'):
+    """Map a snapshot (by default the latest one) into memory.
+
+    The arrays are backed by the snapshot files, so only the pages that are
+    actually used get read from disk. For sparse snapshots, ``data`` is a
+    ``scipy.sparse.csr_matrix`` over the mapped CSR arrays."""
+    if version is None:
+        version = latest_version(directory)
+    path = snapshot_path(version, directory)
+
+    def load(name):
+        return np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+    arrays = {name: load(name) for name in _ARRAYS}
+
+    if os.path.exists(os.path.join(path, "csr_indptr.npy")):
+        from scipy import sparse as sp
+
+        shape = (len(arrays["movie_ids"]), len(arrays["user_ids"]))
+        data = sp.csr_matrix(tuple(load(name) for name in _SPARSE_ARRAYS),
+                shape=shape, copy=False)
+    else:
+        data = load("data")
+
+    return Snapshot(version, data, **arrays)
+
+def main():
+    args = sys.argv[1:]
+    sparse = "--sparse" in args
+    if sparse:
+        args.remove("--sparse")
+    if len(args) not in (0, 2):
+        raise ValueError('Usage: ./knn_snapshot.py [--sparse] [MOVIES_CSV RATINGS_CSV]')
+
+    version = write_snapshot(*args, sparse=sparse)
+    print("Snapshot %s written to %s" % (version, snapshot_path(version)))
+
+if __name__ == "__main__":
+    main()
@@ -16,109 +16,512 @@ import datetime
 import logging
 import asyncio
 import aiocoap.resource as resource
+import aiocoap.error as error
 import aiocoap
 import json
 import time
+import concurrent.futures
+import multiprocessing
+import os
+from collections import OrderedDict
 import sys
 import numpy as np
-import pandas as pd
-from itertools import islice
 
+import knn_shard
+import knn_snapshot
 
-class KNNResource(resource.Resource):
-    """Resource managing KNN recommendation algorithm for movie-rating data."""
 
-    def __init__(self):
-        super().__init__()
+class ResultCache:
+    """Least recently used cache whose entries also expire `ttl` seconds
+    after they were stored; counts its hits and misses"""
 
-        # pre-process full data set
-        self._load_movie_data()
+    def __init__(self, size=1024, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
 
-    def _load_movie_data(self):
-        # import movie data
-        movie_data = pd.read_csv("data/movies-small.csv",
-            usecols=['movieId', 'title'],
-            dtype={'movieId': 'int32', 'title': 'str'})
+    def get(self, key):
+        try:
+            expires, value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
 
-        # import corresponding ratings
-        rating_data = pd.read_csv("data/ratings-small.csv",
-            usecols=['userId', 'movieId', 'rating'],
-            dtype={'userId': 'int32', 'movieId': 'int32', 'rating': 'float32'})
+        if expires < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
 
-        print("read in csv")
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
 
-        # determine least popular movies and drop
-        movies_count = pd.DataFrame(rating_data.groupby('movieId').size(), columns=['count'])
-        popular_movie_ids = movies_count[movies_count['count'] >= 50].index
-        ratings_drop_movies = rating_data[rating_data.movieId.isin(popular_movie_ids)]
-        updated_movie_data = movie_data[movie_data.movieId.isin(popular_movie_ids)]
+    def put(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
 
-        print("drop least popular movies")
+    def clear(self):
+        self._entries.clear()
 
-        # determine least active users and drop
-        ratings_count = pd.DataFrame(rating_data.groupby('userId').size(), columns=['count'])
-        active_user_ids = ratings_count[ratings_count['count'] >= 50].index
-        ratings_drop_movies_users = ratings_drop_movies[ratings_drop_movies.userId.isin(active_user_ids)]
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
 
-        print("drop least active users")
 
-        # create movie vs user matrix for KNN computations
-        self.data = ratings_drop_movies_users.pivot(index='movieId', columns='userId', values='rating').fillna(0)
+class KNNResource(resource.Resource):
+    """Resource managing KNN recommendation algorithm for movie-rating data.
+
+    The worker owns a number of `partitions` of the data set, each given by
+    its rows as a (start, end) pair (as assigned by the parallelism
+    directory, by default a single partition of all rows); owning none
+    makes it a spare. Requests that name other partitions in their ``rows``
+    (because the worker stands in for one that is slow or gone) are served
+    as well, from those rows of the memory-mapped snapshot; the searchers for
+    the last few of those are kept around.
+
+    Every partition is searched by a :class:`knn_shard.Shard` of its own,
+    and their results are merged. The shards describe the available
+    ``metric`` and ``mode`` (and ``probes``) parameters; see
+    :meth:`measure_recall` for choosing the latter. Instead of a single
+    movie, a request can carry a list of ``queries``, which are all computed
+    with one matrix-matrix product against every partition.
+
+    With `processes`, the search runs in a pool of that many processes that
+    all work on one copy of the partitions in shared memory, so the event
+    loop stays responsive, all cores of the host can be used, and the
+    partitions of a request are searched in parallel. Partitions the worker
+    only stands in for are searched in threads then.
+
+    Responses are JSON lists of (movieId, title, distance) string tuples by
+    default. Clients that accept ``application/cbor`` get lists of (movieId,
+    distance) pairs, and clients that accept ``application/octet-stream`` get
+    packed little-endian (int32 movieId, float32 distance) records, where in
+    a batch every query's records are preceded by their int32 count (-1 for
+    unknown movies); titles can then be looked up once for the final merged
+    result through a :class:`TitlesResource`.
+
+    Results are kept in a :class:`ResultCache` per partition, keyed by
+    everything they depend on, including the partition's rows and the
+    snapshot version. When the directory moves partitions, the searchers,
+    shared memory and cached results of the partitions the worker keeps
+    stay valid and are reused. A GET on the resource reports the cache
+    counters."""
+
+    ct = " ".join(str(aiocoap.numbers.media_types_rev[m]) for m in
+            ('application/json', 'application/cbor', 'application/octet-stream'))
+
+    #: Number of searchers for partitions of other workers that are kept
+    max_standins = 16
+
+    def __init__(self, partitions=None, processes=0):
+        super().__init__()
 
-        # reformat movie_data to be indexed on movie_id
-        movie_data = movie_data.set_index('movieId')
-        self.movie_mapping = movie_data
+        # results are cached per partition, so there are a few more entries
+        self.cache = ResultCache(size=16384)
+        self.searchers = {}
+        self.standin_searchers = OrderedDict()
+        self.processes = processes
+        self.pool = None
+        # partitions the current pool has, which lag behind the worker's own
+        # while a new pool is being set up
+        self.pool_partitions = ()
+        self._pool_update = None
+        # shared memory blocks and description of each partition in the pool
+        self.shared = {}
 
-    def _euclidean_distance(self, x, y):
-        return np.linalg.norm(x - y)
+        # pre-process full data set
+        self._load_movie_data()
+        self.assign_partitions([(0, len(self.movie_ids))] if partitions is None else partitions)
+
+    def _load_movie_data(self):
+        # map the preprocessed movie vs user matrix into memory, building the
+        # snapshot first if knn_snapshot.py was never run
+        try:
+            snapshot = knn_snapshot.load_snapshot()
+        except FileNotFoundError:
+            print("no snapshot found, building one from csv")
+            snapshot = knn_snapshot.load_snapshot(knn_snapshot.write_snapshot())
+
+        print("loaded snapshot %s" % snapshot.version)
+
+        self.snapshot = snapshot
+        self.data_version = snapshot.version
+        self.cache.clear()
+        self.standin_searchers.clear()
+
+        # remember which movie each row is
+        self.movie_ids = snapshot.movie_ids
+        self.movie_rows = {movie_id: row for row, movie_id in enumerate(self.movie_ids.tolist())}
+
+        # title of every row, and the movie_id for every title, both as given
+        # and normalized
+        self.titles = snapshot.titles
+        self.title_ids = {}
+        for movie_id, title in zip(self.movie_ids.tolist(), self.titles.tolist()):
+            self.title_ids.setdefault(title, movie_id)
+            self.title_ids.setdefault(self._normalize_title(title), movie_id)
+
+    @staticmethod
+    def _normalize_title(title):
+        return " ".join(title.split()).casefold()
+
+    def _find_movie(self, payload):
+        """Snapshot row of the movie a request is about, given either by its
+        movie_id or its (possibly differently cased or spaced) title"""
+        if not isinstance(payload, dict):
+            raise error.BadRequest("Invalid query")
+        if "movie_id" in payload:
+            try:
+                movie_id = int(payload["movie_id"])
+            except (TypeError, ValueError):
+                raise error.BadRequest("Invalid movie_id")
+        else:
+            title = payload.get("movie_title")
+            if not isinstance(title, str):
+                raise error.BadRequest("Query needs a movie_id or a movie_title")
+            movie_id = self.title_ids.get(title)
+            if movie_id is None:
+                movie_id = self.title_ids.get(self._normalize_title(title))
+        return self.movie_rows.get(movie_id)
+
+    def assign_partitions(self, partitions):
+        """Restrict the worker to the rows of the given (start, end)
+        `partitions`.
+
+        Only views of those rows are kept, so apart from the query movies'
+        own rows, no other part of the memory-mapped snapshot is ever paged
+        in by this worker. Searchers of partitions the worker already had
+        (or stood in for) are kept, so that only new partitions cost any
+        work."""
+        self.partitions = tuple(sorted(tuple(partition) for partition in partitions))
+
+        searchers = {}
+        for partition in self.partitions:
+            searcher = self.searchers.get(partition) or self.standin_searchers.pop(partition, None)
+            searchers[partition] = searcher if searcher is not None else self._new_searcher(partition)
+        self.searchers = searchers
+
+        print("serving %d partitions of %d rows in total" % (len(self.partitions),
+                sum(end - start for start, end in self.partitions)))
+
+        if self.processes:
+            # the pool is replaced in the background; until then, partitions
+            # that are new to the worker are searched in threads
+            self._pool_update = asyncio.ensure_future(self._update_pool(self._pool_update,
+                    self.partitions, dict(self.searchers)))
+
+    def _new_searcher(self, partition):
+        start, end = partition
+        return knn_shard.Shard(self.snapshot.data[start:end], self.snapshot.sq_norms[start:end], start)
+
+    def _searcher(self, partition):
+        """Searcher for the rows ``[start:end)`` of `partition`"""
+        if partition in self.searchers:
+            return self.searchers[partition]
+
+        searcher = self.standin_searchers.get(partition)
+        if searcher is None:
+            print("standing in for rows [%d:%d)" % partition)
+            searcher = self._new_searcher(partition)
+            self.standin_searchers[partition] = searcher
+            while len(self.standin_searchers) > self.max_standins:
+                self.standin_searchers.popitem(last=False)
+        self.standin_searchers.move_to_end(partition)
+        return searcher
+
+    async def _update_pool(self, previous, partitions, searchers):
+        """Replace any pool that still works on previous partitions with one
+        for `partitions`, doing all the slow parts (copying the partitions
+        into shared memory, starting the processes and waiting for the old
+        pool's searches) outside the event loop"""
+        # updates happen one after the other, so the latest one wins
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        loop = asyncio.get_event_loop()
+
+        # only the partitions that are new to the worker get copied into
+        # shared memory
+        new = [partition for partition in partitions if partition not in self.shared]
+        shared = await loop.run_in_executor(None, lambda: [searchers[partition].share() for partition in new])
+        self.shared.update(zip(new, shared))
+
+        pool = None
+        if partitions:
+            pool = concurrent.futures.ProcessPoolExecutor(self.processes,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=knn_shard.attach,
+                    initargs=([self.shared[partition][1] for partition in partitions],))
+            await loop.run_in_executor(None, self._start_processes, pool, self.processes)
+
+        old, self.pool, self.pool_partitions = self.pool, pool, partitions
+        if old is not None:
+            await loop.run_in_executor(None, old.shutdown)
+
+        # no pool works on the other partitions any more
+        for partition in set(self.shared) - set(partitions):
+            self._release(self.shared.pop(partition)[0])
+
+    @staticmethod
+    def _start_processes(pool, processes):
+        # processes are started as tasks are submitted, so a burst of tasks
+        # starts them all, and they are set up once those return
+        for future in [pool.submit(os.getpid) for _ in range(processes)]:
+            future.result()
+
+    def _stop_pool(self):
+        if self._pool_update is not None:
+            self._pool_update.cancel()
+            self._pool_update = None
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+            self.pool_partitions = ()
+
+    @staticmethod
+    def _release(blocks):
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    def shutdown(self):
+        """Stop the process pool and release the shared memory"""
+        self._stop_pool()
+        for blocks, description in self.shared.values():
+            self._release(blocks)
+        self.shared = {}
+
+    def _query_vectors(self, query_rows):
+        queries = self.snapshot.data[query_rows]
+        if hasattr(queries, 'toarray'):
+            # CSR rows; products with the shard are sparse products either way
+            queries = queries.toarray()
+        return np.asarray(queries)
+
+    def _nearest_args(self, query_rows, num_recs, metric='euclidean', mode='exact', probes=None):
+        # the query vectors are looked up here, as the shard (which is
+        # possibly in a different process) only has its own rows
+        query_rows = np.asarray(query_rows, dtype=np.intp)
+        return (query_rows, self._query_vectors(query_rows), np.asarray(self.snapshot.sq_norms[query_rows]),
+                num_recs, metric, mode, probes)
+
+    async def _nearest(self, partition, *args):
+        """For each of the movies in the given snapshot rows, the snapshot
+        rows of the closest movies of the partition and their distances,
+        computed in the process pool if it is one of the worker's own
+        partitions and there is a pool, and in a thread otherwise (unless the
+        worker has no processes to compute in)"""
+        args = self._nearest_args(*args)
+        loop = asyncio.get_event_loop()
+        if self.pool is not None and partition in self.pool_partitions:
+            return await loop.run_in_executor(self.pool, knn_shard.nearest, partition, *args)
+
+        searcher = self._searcher(partition)
+        if self.processes:
+            # the pool only has the worker's own partitions, so stand-ins
+            # (and all searches of spares, which have no pool, or of new
+            # partitions before the pool has them) run in threads to keep the
+            # event loop responsive; the products release the GIL
+            return await loop.run_in_executor(None, searcher.nearest, *args)
+        return searcher.nearest(*args)
+
+    def measure_rate(self, rows=5000, queries=20, seed=0):
+        """Rows per second that a single process scans in exact euclidean
+        queries, measured on up to `rows` rows of the snapshot; this is what
+        the worker reports to the directory as the speed of each of its
+        cores"""
+        rows = min(rows, len(self.movie_ids))
+        searcher = knn_shard.Shard(self.snapshot.data[:rows], self.snapshot.sq_norms[:rows], 0)
+        sample = np.random.default_rng(seed).choice(len(self.movie_ids), queries)
+
+        started = time.perf_counter()
+        for row in sample:
+            searcher.nearest(*self._nearest_args([row], 5))
+        return rows * queries / max(time.perf_counter() - started, 1e-9)
+
+    def measure_recall(self, metric='euclidean', num_recs=5, probes=None, queries=100, seed=0):
+        """Run up to `queries` randomly picked movies through both the exact
+        and the approximate search, and return the mean recall of the
+        approximate results and the mean time per query of either mode"""
+        rng = np.random.default_rng(seed)
+        total = len(self.movie_ids)
+        sample = rng.choice(total, min(queries, total), replace=False)
+        searcher = self._searcher((0, total))
+
+        timings = {}
+        results = {}
+        for mode in knn_shard.Shard.modes:
+            started = time.perf_counter()
+            results[mode] = [set(searcher.nearest(*self._nearest_args([row], num_recs, metric, mode, probes))[0][0])
+                    for row in sample]
+            timings[mode] = (time.perf_counter() - started) / max(len(sample), 1)
+
+        recalls = [len(exact & approx) / len(exact)
+                for exact, approx in zip(results['exact'], results['approx']) if exact]
+        recall = sum(recalls) / len(recalls) if recalls else 1.0
+
+        return recall, timings['exact'], timings['approx']
 
     async def render_parallelize(self, request):
-        payload = json.loads(request.payload.decode('ascii'))
+        # malformed requests are client errors; anything else would make a
+        # coordinator count this worker as failed and ask others in vain
+        try:
+            payload = json.loads(request.payload.decode('ascii'))
+        except ValueError:
+            raise error.BadRequest("Payload must be JSON")
+        if not isinstance(payload, dict):
+            raise error.BadRequest("Payload must be a JSON object")
 
         # load parameters
-        num_recs = int(payload["num_recs"])
-        movie_title = payload["movie_title"]
-        index = int(payload["index"])
-        length = int(payload["length"])
+        num_recs = payload.get("num_recs")
+        if not isinstance(num_recs, int) or isinstance(num_recs, bool) or num_recs < 1:
+            raise error.BadRequest("num_recs must be a positive integer")
+        metric = payload.get("metric", "euclidean")
+        mode = payload.get("mode", "exact")
+        probes = payload.get("probes")
         print('PARALLELIZE payload: %s' % payload)
 
-        # get id for input movie
-        movie_id = self.movie_mapping[self.movie_mapping["title"] == movie_title].index[0]
-        print(movie_id)
-        movie_data = self.data.loc[movie_id]
-
-        # list to save all distances
-        dists = []
+        if metric not in knn_shard.Shard.metrics:
+            raise error.BadRequest("Unknown metric, use one of %s" % ", ".join(knn_shard.Shard.metrics))
+        if mode not in knn_shard.Shard.modes:
+            raise error.BadRequest("Unknown mode, use one of %s" % ", ".join(knn_shard.Shard.modes))
+        if probes is not None and (not isinstance(probes, int) or isinstance(probes, bool) or probes < 1):
+            raise error.BadRequest("probes must be a positive integer or null")
+
+        # requests may name the partitions they expect to be searched here,
+        # which are other ones than the worker's own when it stands in for a
+        # straggling or failed worker
+        partitions = self.partitions
+        if "rows" in payload:
+            partitions = payload["rows"]
+            if not (isinstance(partitions, list) and all(isinstance(partition, list)
+                    and len(partition) == 2 and all(isinstance(bound, int) for bound in partition)
+                    and 0 <= partition[0] <= partition[1] <= len(self.movie_ids)
+                    for partition in partitions)):
+                raise error.BadRequest("Invalid rows")
+            partitions = [tuple(partition) for partition in partitions]
+            # rows searched twice would show up twice in the merged results
+            ordered = sorted(partitions)
+            if any(previous[1] > following[0] for previous, following in zip(ordered, ordered[1:])):
+                raise error.BadRequest("Overlapping rows")
+
+        # a batch of queries (each given like a single one) is answered with
+        # one list of recommendations per query, or null for unknown movies
+        batch = "queries" in payload
+        queries = payload["queries"] if batch else [payload]
+        if not isinstance(queries, list):
+            raise error.BadRequest("queries must be a list")
+
+        accept = request.opt.accept
+        if accept is None:
+            accept = aiocoap.numbers.media_types_rev['application/json']
+        encode = self._encoders.get(aiocoap.numbers.media_types.get(accept))
+        if encode is None:
+            return aiocoap.Message(code=aiocoap.NOT_ACCEPTABLE)
+
+        # get rows for input movies
+        rows = [self._find_movie(query) for query in queries]
+        if not batch and rows[0] is None:
+            return aiocoap.Message(code=aiocoap.NOT_FOUND,
+                    payload=b"No such movie in the data set")
+
+        queried = [row for row in rows if row is not None]
+
+        async def search(partition):
+            # answer repeated queries from the cache, and compute all others
+            # together
+            keys = [(self.movie_ids[row], metric, mode, probes, num_recs) + partition + (self.data_version,)
+                    for row in queried]
+            results = [self.cache.get(key) for key in keys]
+            missing = [i for i, result in enumerate(results) if result is None]
+
+            computed = await self._nearest(partition, [queried[i] for i in missing],
+                    num_recs, metric, mode, probes) if missing else []
+            for i, result in zip(missing, computed):
+                results[i] = result
+                self.cache.put(keys[i], result)
+            return results
+
+        # merge the results of all partitions for every query
+        searched = await asyncio.gather(*map(search, partitions))
+        merged = iter([knn_shard.merge([results[i] for results in searched], num_recs)
+                for i in range(len(queried))])
+        results = [None if row is None else next(merged) for row in rows]
 
-        # compute start and end indices for this shard
-        window_size = int(len(self.data) / length)
-        start = window_size * index
-        end = start + window_size if index < length - 1 else None
-
-        # find euclidean distances for all movies in this shard
-        for index, row in islice(self.data.iterrows(), start, end):
-            # skip over input movie
-            if (str(index) != str(movie_id)):
-                dist = self._euclidean_distance(movie_data, row)
-                dists.append((index, dist))
-
-        # sort distances in ascending order
-        dists.sort(key=lambda x: x[1])
+        # create payload
+        payload = encode(self, results, batch)
 
-        # trim to num_recs recommendations
-        top_movies = dists[:num_recs]
+        return aiocoap.Message(code=aiocoap.COMPUTED, payload=payload, content_format=accept)
 
+    def _encode_json(self, results, batch):
         # convert to string data type for json
-        for i in range(len(top_movies)):
-            movie_id = str(top_movies[i][0])
-            title = self.movie_mapping.loc[top_movies[i][0]]["title"]
-            dist = str(top_movies[i][1])
-            top_movies[i] = (movie_id, title, dist)
+        results = [None if result is None else
+                [(str(self.movie_ids[position]), str(self.titles[position]), str(dist))
+                    for position, dist in zip(*result)]
+                for result in results]
+        return json.dumps(results if batch else results[0]).encode('ascii')
+
+    def _encode_cbor(self, results, batch):
+        import cbor
+
+        results = [None if result is None else
+                [[movie_id, dist] for movie_id, dist in zip(self.movie_ids[result[0]].tolist(), result[1].tolist())]
+                for result in results]
+        return cbor.dumps(results if batch else results[0])
+
+    def _encode_packed(self, results, batch):
+        chunks = []
+        for result in results:
+            if batch:
+                chunks.append(np.array([-1 if result is None else len(result[0])], dtype='<i4').tobytes())
+            if result is None:
+                continue
+
+            records = np.empty(len(result[0]), dtype=[('movie_id', '<i4'), ('dist', '<f4')])
+            records['movie_id'] = self.movie_ids[result[0]]
+            records['dist'] = result[1]
+            chunks.append(records.tobytes())
+        return b"".join(chunks)
+
+    _encoders = {
+            'application/json': _encode_json,
+            'application/cbor': _encode_cbor,
+            'application/octet-stream': _encode_packed,
+            }
+
+    async def render_get(self, request):
+        status = {"partitions": self.partitions, "version": self.data_version, "cache": self.cache.stats()}
+
+        return aiocoap.Message(payload=json.dumps(status).encode('ascii'))
+
+
+class TitlesResource(resource.Resource):
+    """Resource resolving the movieIds given as ``id=`` query parameters to
+    their titles, so that clients of compact KNN responses can look up the
+    titles of their merged results in one go"""
+
+    def __init__(self, knn):
+        super().__init__()
+        self.knn = knn
 
-        # create payload
-        payload = json.dumps(top_movies).encode('ascii')
+    async def render_get(self, request):
+        titles = {}
+        for q in request.opt.uri_query:
+            k, _, v = q.partition('=')
+            if k != 'id':
+                continue
+            try:
+                row = self.knn.movie_rows.get(int(v))
+            except ValueError:
+                raise error.BadRequest("Invalid movie id")
+            if row is not None:
+                titles[v] = str(self.knn.titles[row])
 
-        return aiocoap.Message(code=aiocoap.COMPUTED, payload=payload)
+        return aiocoap.Message(payload=json.dumps(titles).encode('ascii'),
+                content_format=aiocoap.numbers.media_types_rev['application/json'])
 
 
 # logging setup
@@ -126,9 +529,49 @@ class KNNResource(resource.Resource):
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("coap-server").setLevel(logging.DEBUG)
 
-async def setup(port):
+# lifetime of the registration with the directory in seconds; it is renewed
+# every third of that
+LIFETIME = 30
+
+async def register(protocol, port, capacity, lifetime=LIFETIME):
+    # create payload for parallelism entity registration, telling the
+    # directory how much data the worker can search how fast
+    payload = dict(capacity, entity=0, address='127.0.0.1', port=port, lt=lifetime)
+    s_payload = json.dumps(payload).encode('ascii')
+    uri = 'coap://127.0.0.1:5000/parallelism-entity'
+
+    # add this worker to base parallelism entity (id 0), or renew its lease
+    request = aiocoap.Message(code=aiocoap.PUT, payload=s_payload, uri=uri)
+    response = await protocol.request(request).response
+    if not response.code.is_successful():
+        raise error.Error("Registration failed: %s" % response.code)
+    return response
+
+def assigned_partitions(assignment):
+    # rows of the partitions the directory assigned to this worker; spares
+    # get none
+    if assignment["ranges"] is None:
+        return ()
+    return tuple(sorted(tuple(assignment["ranges"][index]) for index in assignment["partitions"]))
+
+async def heartbeat(protocol, port, capacity, knn):
+    # keep the registration alive, and follow the directory when it hands
+    # this worker other partitions (when workers join, or leave or their
+    # lease runs out)
+    while True:
+        await asyncio.sleep(LIFETIME / 3)
+        try:
+            response = await register(protocol, port, capacity)
+        except Exception as e:
+            print('Failed to renew registration: %s' % e)
+            continue
+
+        partitions = assigned_partitions(json.loads(response.payload.decode('ascii')))
+        if partitions != knn.partitions:
+            knn.assign_partitions(partitions)
+
+async def setup(port, processes):
     # set up address and port
-    address = '127.0.0.1'
     port = int(port)
 
     # resource tree creation
@@ -136,34 +579,81 @@ async def setup(port):
 
     root.add_resource(['.well-known', 'core'],
             resource.WKCResource(root.get_resources_as_linkheader))
-    root.add_resource(['knn'], KNNResource())
 
     protocol = await asyncio.Task(aiocoap.Context.create_server_context(root, bind=('127.0.0.1', port)))
 
-    # create payload for parallelism entity registration
-    payload = {"entity": 0, "address": address, "port": port}
-    s_payload = json.dumps(payload).encode('ascii')
-    uri = 'coap://127.0.0.1:5000/parallelism-entity'
-
-    # add this worker to base parallelism entity (id 0)
-    request = aiocoap.Message(code=aiocoap.PUT, payload=s_payload, uri=uri)
+    # map the data set without searching any of it yet, and measure how
+    # fast this host is, so that the directory can weigh its share
+    knn = KNNResource([], processes)
+    capacity = {"cores": max(processes, 1), "rate": knn.measure_rate(), "rows": len(knn.movie_ids)}
+    print('Capacity: %r' % capacity)
 
     try:
-        response = await protocol.request(request).response
+        response = await register(protocol, port, capacity)
+        assignment = json.loads(response.payload.decode('ascii'))
     except Exception as e:
+        # serve the whole data set when running standalone
         print('Failed to join parallelism entity')
+        partitions = [(0, len(knn.movie_ids))]
+        registered = False
     else:
-        print('Result: %s\n%r'%(response.code, json.loads(response.payload.decode('ascii'))))
+        print('Result: %s\n%r'%(response.code, assignment))
+        partitions = assigned_partitions(assignment)
+        registered = True
+
+    # only search the rows this worker was assigned
+    knn.assign_partitions(partitions)
+    root.add_resource(['knn'], knn)
+    root.add_resource(['knn', 'titles'], TitlesResource(knn))
+
+    if registered:
+        asyncio.ensure_future(heartbeat(protocol, port, capacity, knn))
+
+    return protocol, knn, capacity, registered
+
+def print_recall():
+    # compare approximate against exact search over the whole data set, for
+    # increasing numbers of probed clusters
+    knn = KNNResource()
+    lists = len(knn.searchers[0, len(knn.movie_ids)].index.lists)
+    for metric in knn_shard.Shard.metrics:
+        probes = 1
+        while True:
+            recall, exact, approx = knn.measure_recall(metric, probes=probes)
+            print('%-9s probes %3d/%d: recall %.3f, %.3f ms/query (exact: %.3f ms/query)' % (
+                metric, probes, lists, recall, approx * 1000, exact * 1000))
+            if probes >= lists:
+                break
+            probes = min(probes * 2, lists)
 
 def main():
-    if len(sys.argv) < 2:
-        raise ValueError('Usage: ./server_knn_parallelism_worker [PORT]')
+    if sys.argv[1:] == ['--measure-recall']:
+        print_recall()
+        return
+
+    if len(sys.argv) not in (2, 3):
+        raise ValueError('Usage: ./server_knn_parallelism_worker [PORT [PROCESSES] | --measure-recall]')
+
+    # number of processes computing distances (0 to compute them in the
+    # event loop), by default one per core
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
 
     # wait for parallelism entity registration to complete
-    asyncio.get_event_loop().run_until_complete(setup(sys.argv[1]))
+    loop = asyncio.get_event_loop()
+    protocol, knn, capacity, registered = loop.run_until_complete(setup(sys.argv[1], processes))
 
     # listen for parallelism requests from clients
-    asyncio.get_event_loop().run_forever()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        # leave the parallelism entity rather than waiting for the lease to
+        # run out
+        if registered:
+            try:
+                loop.run_until_complete(asyncio.wait_for(register(protocol, int(sys.argv[1]), capacity, 0), 5))
+            except Exception as e:
+                print('Failed to leave parallelism entity: %s' % e)
+        knn.shutdown()
 
 if __name__ == "__main__":
     main()
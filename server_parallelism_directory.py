@@ -15,40 +15,510 @@ for some more information."""
 import datetime
 import logging
 import asyncio
+import collections
+import math
 import aiocoap.resource as resource
+import aiocoap.parallelism as parallelism
+import aiocoap.error as error
 import aiocoap
 import json
+import os
+import struct
+import sys
+import time
 
 
-class ParallelismEntityResource(resource.Resource):
-    """Resource managing parallelism entities."""
+def _is_positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
 
-    def __init__(self, root, port):
+def _is_positive_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) \
+            and math.isfinite(value) and value > 0
+
+class ParallelismEntityResource(resource.ObservableResource):
+    """Resource managing parallelism entities.
+
+    Besides tracking the members of the base parallelism entity, this hands
+    out shard assignments: the rows of the data set are cut into a fixed
+    number of equally sized `partitions`, and every partition is owned by
+    the `replicas` members that :func:`parallelism.rendezvous` picks for it
+    (or all members, if there are fewer). Every registering worker is told
+    which partitions it owns, so that it only needs to load those rows of
+    the data; members that win no partition are kept as spares.
+
+    Queries only go to one replica of every partition, so replicas add read
+    throughput, and losing a member does not lose any of the data as long
+    as there is another replica.
+
+    Rendezvous hashing keeps the assignment mostly stable: when a worker
+    joins, it mainly takes over the partitions it wins (about 1/N of them),
+    and when it leaves, mainly its own partitions move to the other members.
+    Most other workers keep their rows, along with whatever they derived and
+    cached from them. That is only a statistical property, though: as the
+    loads are bounded (see below), a change can also shift a few partitions
+    between other members.
+
+    Workers report their capacity when they register: the number of
+    ``rows`` in the data set, and how many ``cores`` they search with at
+    which ``rate`` (rows per second and core). Members win partitions in
+    proportion to their capacities, so that all of them take about the same
+    time for a query; members that did not report a capacity count as
+    average. With as few partitions as there usually are, the hashing alone
+    can easily hand a member twice its share, so no member gets more than
+    its share (rounded up) plus `load_slack` of it; partitions it would win
+    beyond that go to the next member in the partition's rendezvous order.
+    More partitions spread the data more evenly.
+
+    Registrations are leases that run out after the ``lt`` seconds given in
+    the registration (`lifetime` by default) unless the worker registers
+    again in the meantime, which workers do as their heartbeat; registering
+    with an ``lt`` of 0 leaves the entity. When a worker's lease runs out, it
+    is removed from the entity, and its partitions go to the remaining
+    members. Workers learn about changes to their partitions from the
+    responses to their heartbeats.
+
+    The shard map of the base parallelism entity carries a version that
+    increases with every change; it can be observed, and observers are
+    notified whenever workers join, leave or expire, or partitions move.
+
+    With a `journal` (a :class:`parallelism.Journal` that the `root` site is
+    set up as a parallelism directory with as well), the leases, capacities
+    and the shard map's version survive restarts of the directory: leases
+    resume with the time they had left, members whose leases ran out in the
+    meantime are removed, and the partitions stay where they were, so that
+    workers carry on without noticing more than a missed heartbeat."""
+
+    #: Fraction of its share of the partitions by which a member may exceed
+    #: it
+    load_slack = 0.1
+
+    def __init__(self, root, port, partitions=64, replicas=1, lifetime=60, journal=None):
         super().__init__()
         self.root = root
         self.port = port
+        self.partitions = partitions
+        self.replicas = replicas
+        self.lifetime = lifetime
 
-    async def render_get(self, request):
-        # list of nodes in base parallelism entity
-        entity = list(self.root.get_parallelism_entity_by_id(0))
+        # reported capacity (rows per second) of each member, and the number
+        # of rows of the data set
+        self.capacities = {}
+        self.rows = None
+
+        # leases of the (entity, member) registrations
+        self.leases = parallelism.Leases(self._expire)
+
+        self.shard_map = {"version": 0, "length": partitions, "replicas": replicas, "rows": None,
+                "ranges": None, "members": [], "owners": []}
+
+        self.journal = journal
+        if journal is not None:
+            self._restore()
+
+    def _restore(self):
+        # resume the leases as of the journal, in wall clock time as the
+        # event loop's clock starts over
+        # records that could not have come from a valid registration (say,
+        # written by an older version) are skipped rather than keeping the
+        # directory from starting
+        now = time.time()
+        rows = self.journal.get(("rows",))
+        if rows is None or _is_positive_int(rows):
+            self.rows = rows
+        else:
+            print('ignoring invalid rows %r in the journal' % (rows,))
+        version = self.journal.get(("version",), 0)
+        if isinstance(version, int) and not isinstance(version, bool):
+            self.shard_map["version"] = version
+        else:
+            print('ignoring invalid version %r in the journal' % (version,))
+
+        leased = set()
+        for key, lease in self.journal.items(("lease",)):
+            if not self._valid_lease(key, lease):
+                print('ignoring invalid lease %r: %r in the journal' % (key, lease))
+                continue
+            kind, entity_id, member = key
+            if lease["capacity"] is not None:
+                self.capacities[member] = lease["capacity"]
+            remaining = lease["expires"] - now
+            if remaining > 0:
+                self.leases.renew((entity_id, member), remaining)
+                leased.add(member)
+            else:
+                print('lease of %s in entity %s expired while the directory was down' % (member, entity_id))
+                self._leave(entity_id, member)
+
+        # members that never got a lease recorded
+        for member in list(self.root.get_parallelism_entity_by_id(0)):
+            if member[1] != self.port and member not in leased:
+                self._leave(0, member)
+
+        self._publish()
+
+    @staticmethod
+    def _valid_lease(key, lease):
+        if len(key) != 3 or not isinstance(lease, dict):
+            return False
+        kind, entity_id, member = key
+        return (isinstance(member, tuple) and len(member) == 2 and isinstance(member[0], str)
+                and _is_positive_int(member[1])
+                and isinstance(lease.get("expires"), (int, float)) and not isinstance(lease["expires"], bool)
+                and (lease.get("capacity") is None or _is_positive_number(lease["capacity"])))
 
-        # remove directory node
-        filtered_entity = [(address, port) for address, port in entity if port != self.port]
+    def _leave(self, entity_id, member):
+        try:
+            self.root.remove_parallelism_entity_member(entity_id, member)
+        except ValueError:
+            pass
+        self.capacities.pop(member, None)
+        if self.journal is not None:
+            self.journal.delete(("lease", entity_id, member))
+        self._publish()
 
-        return aiocoap.Message(payload=json.dumps(filtered_entity).encode('ascii'))
+    def _expire(self, key):
+        entity_id, member = key
+        print('lease of %s in entity %s expired' % (member, entity_id))
+        self._leave(entity_id, member)
+
+    def _ranges(self):
+        # cut the rows into equally sized partitions
+        if self.rows is None:
+            return None
+        return [[self.rows * index // self.partitions, self.rows * (index + 1) // self.partitions]
+                for index in range(self.partitions)]
+
+    def _owners(self, members):
+        # indices into members of the owners of each partition, weighted by
+        # the members' capacities
+        if not members:
+            return []
+
+        known = [self.capacities[member] for member in members if member in self.capacities]
+        average = sum(known) / len(known) if known else 1.0
+        weights = {member: self.capacities.get(member, average) for member in members}
+
+        # the most partition replicas every member may own
+        replicas = min(self.replicas, len(members))
+        total = sum(weights.values())
+        bounds = {member: math.ceil(self.partitions * replicas * weights[member] / total * (1 + self.load_slack))
+                for member in members}
+
+        load = collections.Counter()
+        owners = []
+        for index in range(self.partitions):
+            ranked = parallelism.rendezvous(index, members, weights, len(members))
+            chosen = [member for member in ranked if load[member] < bounds[member]][:replicas]
+            # the members with room left can be too few to hold all replicas
+            chosen += [member for member in ranked if member not in chosen][:replicas - len(chosen)]
+            load.update(chosen)
+            owners.append([members.index(owner) for owner in chosen])
+        return owners
+
+    def _compute_shard_map(self, entity_id=0):
+        # list of nodes in parallelism entity, without the directory node
+        entity = self.root.get_parallelism_entity_by_id(entity_id)
+        members = sorted((address, port) for address, port in entity if port != self.port)
+
+        return {"length": self.partitions, "replicas": self.replicas, "rows": self.rows, "ranges": self._ranges(),
+                "members": [list(member) for member in members], "owners": self._owners(members)}
+
+    def _publish(self):
+        # publish the current shard map as a new version if anything changed
+        current = self._compute_shard_map()
+        published = dict(self.shard_map)
+        del published["version"]
+        if current != published:
+            before = self._partition_owners(published)
+            after = self._partition_owners(current)
+            if before:
+                moved = sum(len(set(new) - set(old)) for old, new in zip(before, after))
+                print('%d of %d partition replicas move' % (moved, self.partitions * self.replicas))
+
+            self.shard_map = dict(current, version=self.shard_map["version"] + 1)
+            if self.journal is not None:
+                self.journal.put(("version",), self.shard_map["version"])
+            self.updated_state()
+
+    @staticmethod
+    def _partition_owners(shard_map):
+        # the (address, port) pairs owning each partition
+        return [[tuple(shard_map["members"][owner]) for owner in owners]
+                for owners in shard_map["owners"]]
+
+    def partitions_of(self, member, shard_map=None):
+        """Indices of the partitions the (address, port) `member` owns a
+        replica of"""
+        if shard_map is None:
+            shard_map = self.shard_map
+        return [index for index, owners in enumerate(self._partition_owners(shard_map))
+                if member in owners]
+
+    def shares(self):
+        # one share per set of members that own the same partitions, with the
+        # rows of those partitions (or None while the size of the data set is
+        # unknown)
+        shard_map = self.shard_map
+        shares = {}
+        for index, owners in enumerate(self._partition_owners(shard_map)):
+            shares.setdefault(tuple(sorted(owners)), []).append(index)
+
+        return [parallelism.Share(list(owners), [shard_map["ranges"][index] for index in partitions]
+                    if shard_map["ranges"] is not None else None)
+                for owners, partitions in shares.items()]
+
+    def chunks(self):
+        # every partition on its own, with its owners
+        shard_map = self.shard_map
+        if shard_map["ranges"] is None:
+            return self.shares()
+        return [parallelism.Share(owners, [shard_map["ranges"][index]])
+                for index, owners in enumerate(self._partition_owners(shard_map))]
+
+    def spares(self):
+        # members without a partition, which can stand in for any share
+        owners = {owner for owners in self._partition_owners(self.shard_map) for owner in owners}
+        return [(address, port) for address, port in self.shard_map["members"]
+                if (address, port) not in owners]
+
+    async def render_get(self, request):
+        return aiocoap.Message(payload=json.dumps(self.shard_map).encode('ascii'))
 
     async def render_put(self, request):
-        print('PUT payload: %s' % request.payload.decode('ascii'))
+        print('PUT payload: %s' % request.payload.decode('ascii', 'replace'))
+
+        # parse arguments from payload; everything is checked before any of
+        # it goes into the directory's state, as a single bad value would
+        # otherwise break the shard map for all later registrations
+        try:
+            payload = json.loads(request.payload.decode('ascii'))
+        except ValueError:
+            raise error.BadRequest("Payload must be JSON")
+        if not isinstance(payload, dict):
+            raise error.BadRequest("Payload must be a JSON object")
 
-        # parse arguments from payload
-        payload = json.loads(request.payload.decode('ascii'))
-        self.root.add_parallelism_entity_member(payload["entity"], (payload["address"], payload["port"]))
+        if not isinstance(payload.get("address"), str):
+            raise error.BadRequest("address must be a string")
+        if not _is_positive_int(payload.get("port")) or payload["port"] > 65535:
+            raise error.BadRequest("port must be a port number")
+        member = (payload["address"], payload["port"])
+        if not isinstance(payload.get("entity"), int) or isinstance(payload["entity"], bool):
+            raise error.BadRequest("entity must be an integer")
+        try:
+            self.root.get_parallelism_entity_by_id(payload["entity"])
+        except KeyError:
+            raise error.BadRequest("No such parallelism entity")
 
-        # get update list of entity members
-        entity = list(self.root.get_parallelism_entity_by_id(payload["entity"]))
-        filtered_entity = [(address, port) for address, port in entity if port != self.port]
+        lifetime = payload.get("lt", self.lifetime)
+        if not (lifetime == 0 or _is_positive_number(lifetime)):
+            raise error.BadRequest("lt must be a non-negative number")
+        if "rows" in payload and not _is_positive_int(payload["rows"]):
+            raise error.BadRequest("rows must be a positive integer")
+        if "cores" in payload and not _is_positive_int(payload["cores"]):
+            raise error.BadRequest("cores must be a positive integer")
+        if "rate" in payload and not _is_positive_number(payload["rate"]):
+            raise error.BadRequest("rate must be a positive number")
 
-        return aiocoap.Message(code=aiocoap.CHANGED, payload=json.dumps(filtered_entity).encode('ascii'))
+        key = (payload["entity"], member)
+        if lifetime == 0:
+            # leaving the entity
+            if key in self.leases:
+                self.leases.cancel(key)
+            self._leave(payload["entity"], member)
+            return aiocoap.Message(code=aiocoap.DELETED)
+
+        # joining, or renewing the lease by heartbeat
+        self.root.add_parallelism_entity_member(payload["entity"], member)
+        self.leases.renew(key, lifetime)
+
+        if "rows" in payload:
+            self.rows = payload["rows"]
+        if "rate" in payload:
+            self.capacities[member] = payload.get("cores", 1) * payload["rate"]
+
+        if self.journal is not None:
+            self.journal.put(("rows",), self.rows)
+            self.journal.put(("lease",) + key, {"expires": time.time() + lifetime,
+                "capacity": self.capacities.get(member)})
+
+        # heartbeats of known members don't change anything
+        self._publish()
+
+        # tell the member which partitions it owns, along with the updated
+        # list of entity members
+        response = dict(self.shard_map, partitions=self.partitions_of(member))
+
+        return aiocoap.Message(code=aiocoap.CHANGED, payload=json.dumps(response).encode('ascii'))
+
+
+def _float32_str(value):
+    # shortest representation of a float32 distance, as the workers' JSON
+    # responses carry them
+    for digits in range(1, 10):
+        text = '%.*g' % (digits, value)
+        if struct.pack('<f', float(text)) == struct.pack('<f', value):
+            return text
+    return repr(value)
+
+class PackedKNNReducer(parallelism.TopKReducer):
+    """:class:`parallelism.TopKReducer` for the packed responses of the KNN
+    workers: little-endian (int32 movieId, float32 distance) records, where
+    in a batch every query's records are preceded by their int32 count (-1
+    for unknown movies). Its items are (movieId, distance) pairs, which are
+    returned as JSON lists."""
+
+    accept = aiocoap.numbers.media_types_rev['application/octet-stream']
+
+    def __init__(self, k=None, batch=None):
+        super().__init__(key=lambda movie: movie[1], k=k, batch=batch)
+
+    def decode(self, response, batch):
+        payload = response.payload
+        if not batch:
+            return [list(struct.iter_unpack('<if', payload))]
+
+        lists = []
+        offset = 0
+        while offset < len(payload):
+            count, = struct.unpack_from('<i', payload, offset)
+            offset += 4
+            if count < 0:
+                lists.append(None)
+                continue
+            lists.append(list(struct.iter_unpack('<if', payload[offset:offset + 8 * count])))
+            offset += 8 * count
+        return lists
+
+class KNNCoordinatorResource(parallelism.CoordinatorResource):
+    """Coordinator for the KNN workers that tells every worker which rows to
+    search (those of the partitions it owns as of the current shard map), so
+    that other replicas, spares and other workers can stand in for a slow or
+    failed owner; their results are merged by distance, query by query for
+    batches of ``queries``.
+
+    Workers are asked for their compact packed responses (see
+    :class:`PackedKNNReducer`), and the titles are looked up only for the
+    final results, in a single request to a member.
+
+    Requests can carry a ``deadline`` in milliseconds, after which the best
+    results of the shares that responded until then are returned, along
+    with the rows of the partitions that are missing (as [start, end]
+    pairs, which stay meaningful when the shard map changes in the
+    meantime).
+
+    Requests with ``steal`` set are processed in work stealing mode, with
+    every partition as a chunk of its own; that works best with many more
+    partitions than workers."""
+
+    def __init__(self, entity, policy=None):
+        reducer = PackedKNNReducer(k=lambda request: self._parameters[request]["num_recs"],
+                batch=lambda request: "queries" in self._parameters[request])
+        super().__init__(entity.shares, reducer, ['knn'], standbys=entity.spares, policy=policy)
+        self.entity = entity
+
+        # checked payloads of the requests being processed
+        self._parameters = {}
+
+    @staticmethod
+    def _parse(request):
+        # check what the coordinator itself needs from the payload; the
+        # workers check the rest, and their client errors are passed on
+        try:
+            payload = json.loads(request.payload.decode('ascii'))
+        except ValueError:
+            raise error.BadRequest("Payload must be JSON")
+        if not isinstance(payload, dict):
+            raise error.BadRequest("Payload must be a JSON object")
+        if not _is_positive_int(payload.get("num_recs")):
+            raise error.BadRequest("num_recs must be a positive integer")
+        if "queries" in payload and not isinstance(payload["queries"], list):
+            raise error.BadRequest("queries must be a list")
+        if payload.get("deadline") is not None and not _is_positive_number(payload["deadline"]):
+            raise error.BadRequest("deadline must be a positive number of milliseconds")
+        if not isinstance(payload.get("steal", False), bool):
+            raise error.BadRequest("steal must be a boolean")
+        return payload
+
+    async def render_parallelize(self, request):
+        payload = self._parameters[request] = self._parse(request)
+        try:
+            response = await super().render_parallelize(request)
+        finally:
+            del self._parameters[request]
+
+        if response.code != aiocoap.COMPUTED:
+            return response
+        return await self._with_titles(response, "queries" in payload)
+
+    async def _with_titles(self, response, batch):
+        # turn the merged (movieId, distance) pairs into (movieId, title,
+        # distance) triples like the workers' JSON responses have
+        result = json.loads(response.payload.decode('utf8'))
+        partial = isinstance(result, dict)
+        results = result["results"] if partial else result
+        lists = results if batch else [results]
+
+        ids = sorted({movie_id for movies in lists if movies is not None for movie_id, dist in movies})
+        titles = await self._titles(ids) if ids else {}
+
+        lists = [None if movies is None else
+                [(str(movie_id), titles.get(str(movie_id)), _float32_str(dist)) for movie_id, dist in movies]
+                for movies in lists]
+        results = lists if batch else lists[0]
+        if partial:
+            result["results"] = results
+        else:
+            result = results
+        response.payload = json.dumps(result).encode('ascii')
+        return response
+
+    async def _titles(self, ids):
+        # every worker can resolve the titles of all movies; ask the others
+        # only if one fails or (with a policy) takes longer than its deadline
+        query = ['id={}'.format(movie_id) for movie_id in ids]
+        timeout = self.policy.deadline if self.policy is not None else None
+        for address, port in self.entity.shard_map["members"]:
+            request = aiocoap.Message(code=aiocoap.GET, uri_query=query,
+                    uri='coap://{}:{}/knn/titles'.format(address, port))
+            try:
+                response = await asyncio.wait_for(self.context.request(request).response, timeout)
+            except asyncio.TimeoutError:
+                logging.warning("Title lookup at %s:%s timed out", address, port)
+                continue
+            except (error.Error, OSError) as e:
+                logging.warning("Title lookup at %s:%s failed: %s", address, port, e)
+                continue
+            if response.code.is_successful():
+                return json.loads(response.payload.decode('utf8'))
+            logging.warning("Title lookup at %s:%s failed: %s", address, port, response.code)
+        return {}
+
+    def get_work_stealing(self, request):
+        return self._parameters[request].get("steal", self.work_stealing)
+
+    async def get_chunks(self):
+        return self.entity.chunks()
+
+    def get_deadline(self, request):
+        deadline = self._parameters[request].get("deadline")
+        return deadline / 1000 if deadline is not None else self.deadline
+
+    def describe_missing(self, shares, missing):
+        if any(shares[number].data is None for number in missing):
+            # no worker told the size of the data set yet
+            return missing
+        return sorted(rows for number in missing for rows in shares[number].data)
+
+    def scatter(self, request, member, share):
+        outgoing = super().scatter(request, member, share)
+
+        if share.data is None:
+            # no worker told the size of the data set yet
+            return outgoing
+
+        payload = dict(self._parameters[request], rows=share.data)
+        outgoing.payload = json.dumps(payload).encode('ascii')
+        return outgoing
 
 
 # logging setup
@@ -56,23 +526,49 @@ class ParallelismEntityResource(resource.Resource):
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("coap-server").setLevel(logging.DEBUG)
 
+# where the directory keeps its state across restarts
+JOURNAL = 'data/directory/entities'
+
 def main():
     # set up address and port
     address = '127.0.0.1'
     port = 5000
 
+    # number of partitions the data set is split into, and of the workers
+    # that hold a replica of each
+    partitions = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    replicas = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    if partitions < 1 or replicas < 1:
+        raise ValueError('Usage: ./server_parallelism_directory.py [PARTITIONS [REPLICAS]]')
+
     # Resource tree creation
     root = resource.Site()
 
     root.add_resource(['.well-known', 'core'],
             resource.WKCResource(root.get_resources_as_linkheader))
-    root.add_resource(['parallelism-entity'], ParallelismEntityResource(root, port))
 
-    # set up server as parallelism directory
-    root.set_up_as_parallelism_directory()
-    root.create_parallelism_entity((address, port))
+    # set up server as parallelism directory, picking up where the last run
+    # left off
+    os.makedirs(os.path.dirname(JOURNAL), exist_ok=True)
+    journal = parallelism.Journal(JOURNAL)
+    root.set_up_as_parallelism_directory(journal)
+    if not root.all_parallelism_entities():
+        root.create_parallelism_entity((address, port))
+
+    entity = ParallelismEntityResource(root, port, partitions, replicas, journal=journal)
+    root.add_resource(['parallelism-entity'], entity)
+
+    # coordinate knn requests for clients: fan them out to one replica of
+    # every partition, and merge their top results by distance; partitions
+    # whose replica takes more than a second or fails are handed to another
+    # worker
+    knn = KNNCoordinatorResource(entity, parallelism.StragglerPolicy(deadline=1))
+    root.add_resource(['knn'], knn)
 
-    asyncio.Task(aiocoap.Context.create_server_context(root, bind=(address, port)))
+    # the coordinator sends its requests from the directory's own context
+    context = asyncio.get_event_loop().run_until_complete(
+            aiocoap.Context.create_server_context(root, bind=(address, port)))
+    knn.context = context
 
     asyncio.get_event_loop().run_forever()
 
@@ -0,0 +1,388 @@
+# This file is part of the Python aiocoap library project.
+#
+# Copyright (c) 2012-2014 Maciej Wasilak <http://sixpinetrees.blogspot.com/>,
+#               2013-2014 Christian Amsüss <c.amsuess@energyharvesting.at>
+#
+# aiocoap is free software, this file is published under the MIT license as
+# described in the accompanying LICENSE file.
+
+import asyncio
+import gc
+import json
+import unittest
+
+import aiocoap
+import aiocoap.error
+import aiocoap.parallelism
+import aiocoap.resource
+
+from .fixtures import WithAsyncLoop
+from .test_server import WithTestServer, WithClient, TestingSite, no_warnings
+
+class FakeContext:
+    """Stand-in for a client context that answers requests from a dict of
+    per-member (delay, response or exception) entries"""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.sent = []
+        self.responses = []
+
+    def request(self, message):
+        self.sent.append(message)
+        host, port = message.remote.hostinfo.rsplit(':', 1)
+        delay, answer = self.answers[(host, int(port))]
+
+        class Request:
+            pass
+        request = Request()
+        request.response = asyncio.ensure_future(self._respond(delay, answer))
+        self.responses.append(request.response)
+        return request
+
+    async def _respond(self, delay, answer):
+        await asyncio.sleep(delay)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+def shard_response(items):
+    return aiocoap.Message(code=aiocoap.COMPUTED, payload=json.dumps(items).encode('utf8'))
+
+class TestCoordinator(WithAsyncLoop):
+    members = [("192.0.2.1", 5001), ("192.0.2.2", 5002)]
+    standbys = [("192.0.2.3", 5003)]
+
+    def coordinator(self, answers, policy=None):
+        context = FakeContext(answers)
+        return aiocoap.parallelism.CoordinatorResource(lambda: self.members,
+                aiocoap.parallelism.TopKReducer(key=lambda item: item[1]), ['knn'], context,
+                lambda: self.standbys, policy), context
+
+    def render(self, coordinator):
+        request = aiocoap.Message(code=aiocoap.PARALLELIZE, payload=b'{"num_recs": 2}')
+        return self.loop.run_until_complete(coordinator.render(request))
+
+    def test_merge(self):
+        coordinator, context = self.coordinator({
+            self.members[0]: (0, shard_response([["a", 1], ["d", 4]])),
+            self.members[1]: (0, shard_response([["b", 2], ["c", 3]])),
+            })
+
+        response = self.render(coordinator)
+
+        self.assertEqual(response.code, aiocoap.COMPUTED)
+        self.assertEqual(json.loads(response.payload.decode('utf8')), [["a", 1], ["b", 2]])
+        self.assertEqual([m.opt.uri_path for m in context.sent], [("knn",), ("knn",)])
+        self.assertEqual([m.payload for m in context.sent], [b'{"num_recs": 2}'] * 2)
+
+    def test_not_acceptable(self):
+        coordinator, context = self.coordinator({
+            self.members[0]: (0, shard_response([["a", 1]])),
+            self.members[1]: (0, shard_response([["b", 2]])),
+            })
+
+        request = aiocoap.Message(code=aiocoap.PARALLELIZE, payload=b'{"num_recs": 2}',
+                accept=aiocoap.numbers.media_types_rev['application/cbor'])
+        response = self.loop.run_until_complete(coordinator.render(request))
+
+        # the reducer only produces JSON, and nothing is asked of the members
+        self.assertEqual(response.code, aiocoap.NOT_ACCEPTABLE)
+        self.assertEqual(context.sent, [])
+
+    def test_decode(self):
+        class TextReducer(aiocoap.parallelism.TopKReducer):
+            accept = aiocoap.numbers.media_types_rev['text/plain']
+
+            def decode(self, response, batch):
+                return [[(name, int(rank)) for name, rank in
+                    (line.split() for line in response.payload.decode('utf8').splitlines())]]
+
+        coordinator, context = self.coordinator({
+            self.members[0]: (0, aiocoap.Message(code=aiocoap.COMPUTED, payload=b"a 1\nd 4")),
+            self.members[1]: (0, aiocoap.Message(code=aiocoap.COMPUTED, payload=b"b 2")),
+            })
+        coordinator.reducer = TextReducer(key=lambda item: item[1], k=2)
+
+        response = self.render(coordinator)
+
+        # members are asked for the format the reducer reads, and the result
+        # comes in the one it produces
+        self.assertEqual([m.opt.accept for m in context.sent], [TextReducer.accept] * 2)
+        self.assertEqual(response.opt.content_format, TextReducer.content_format)
+        self.assertEqual(json.loads(response.payload.decode('utf8')), [["a", 1], ["b", 2]])
+
+    def test_failing_member(self):
+        coordinator, context = self.coordinator({
+            self.members[0]: (0, shard_response([["a", 1]])),
+            self.members[1]: (0, aiocoap.error.RequestTimedOut()),
+            })
+
+        response = self.render(coordinator)
+
+        self.assertEqual(response.code, aiocoap.BAD_GATEWAY)
+
+    def test_rejected(self):
+        coordinator, context = self.coordinator({
+            self.members[0]: (0, aiocoap.Message(code=aiocoap.NOT_FOUND, payload=b"No such movie")),
+            self.members[1]: (0, shard_response([["b", 2]])),
+            self.standbys[0]: (0, shard_response([["c", 3]])),
+            }, aiocoap.parallelism.StragglerPolicy(deadline=0.05, hedge_percentile=None))
+
+        response = self.render(coordinator)
+
+        # client errors are passed on rather than asked from anyone else
+        self.assertEqual(response.code, aiocoap.NOT_FOUND)
+        self.assertEqual(response.payload, b"No such movie")
+        self.assertEqual(len(context.sent), 2)
+
+    def test_redispatch(self):
+        coordinator, context = self.coordinator({
+            self.members[0]: (0, shard_response([["a", 1]])),
+            self.members[1]: (10, shard_response([["b", 2]])),
+            self.standbys[0]: (0, shard_response([["c", 3]])),
+            }, aiocoap.parallelism.StragglerPolicy(deadline=0.05, hedge_percentile=None))
+
+        response = self.render(coordinator)
+
+        self.assertEqual(response.code, aiocoap.COMPUTED)
+        self.assertEqual(json.loads(response.payload.decode('utf8')), [["a", 1]])
+        self.assertEqual(len(context.sent), 3)
+        self.assertTrue(context.responses[1].cancelled())
+
+    def test_hedge(self):
+        policy = aiocoap.parallelism.StragglerPolicy(hedge_percentile=50, min_samples=1)
+        policy.record(0.01)
+        coordinator, context = self.coordinator({
+            self.members[0]: (0, shard_response([["a", 1]])),
+            self.members[1]: (10, shard_response([["b", 2]])),
+            self.standbys[0]: (0, shard_response([["c", 3]])),
+            }, policy)
+
+        response = self.loop.run_until_complete(asyncio.wait_for(coordinator.render(
+            aiocoap.Message(code=aiocoap.PARALLELIZE, payload=b'{}')), 1))
+
+        self.assertEqual(json.loads(response.payload.decode('utf8')), [["a", 1]])
+        self.assertEqual(len(context.sent), 3)
+        # the straggler's request is given up on
+        self.assertTrue(context.responses[1].cancelled())
+
+    def test_partial(self):
+        coordinator, context = self.coordinator({
+            self.members[0]: (0, shard_response([["a", 1]])),
+            self.members[1]: (10, shard_response([["b", 2]])),
+            })
+        coordinator.deadline = 0.05
+
+        response = self.render(coordinator)
+
+        self.assertEqual(response.code, aiocoap.COMPUTED)
+        self.assertEqual(json.loads(response.payload.decode('utf8')),
+                {"results": [["a", 1]], "missing": [1]})
+        # the late request gets cancelled once the loop runs on
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertTrue(context.responses[1].cancelled())
+
+    def test_partial_described(self):
+        coordinator, context = self.coordinator({
+            self.members[0]: (0, shard_response([["a", 1]])),
+            self.members[1]: (10, shard_response([["b", 2]])),
+            })
+        coordinator.deadline = 0.05
+        coordinator.members = lambda: [aiocoap.parallelism.Share([member], "rows of %s" % member[0])
+                for member in self.members]
+        coordinator.describe_missing = lambda shares, missing: [shares[number].data for number in missing]
+
+        response = self.render(coordinator)
+
+        self.assertEqual(json.loads(response.payload.decode('utf8'))["missing"], ["rows of 192.0.2.2"])
+
+    def test_partial_timeout(self):
+        coordinator, context = self.coordinator({
+            self.members[0]: (10, shard_response([["a", 1]])),
+            self.members[1]: (10, shard_response([["b", 2]])),
+            })
+        coordinator.deadline = 0.05
+
+        response = self.render(coordinator)
+
+        self.assertEqual(response.code, aiocoap.GATEWAY_TIMEOUT)
+
+    def test_replicas(self):
+        coordinator, context = self.coordinator({
+            self.members[0]: (0, aiocoap.error.RequestTimedOut()),
+            self.members[1]: (0.01, shard_response([["b", 2]])),
+            })
+        coordinator.members = lambda: [aiocoap.parallelism.Share(self.members, None)]
+
+        # without a policy, the share is still sent to its other replica
+        response = self.render(coordinator)
+        self.assertEqual(json.loads(response.payload.decode('utf8')), [["b", 2]])
+        self.assertEqual(len(context.sent), 2)
+
+        # the failure counts against the first replica from then on
+        response = self.render(coordinator)
+        self.assertEqual(json.loads(response.payload.decode('utf8')), [["b", 2]])
+        self.assertEqual(len(context.sent), 3)
+        self.assertEqual(context.sent[2].remote.hostinfo, "192.0.2.2:5002")
+        self.assertEqual(coordinator.get_load(self.members[0]), (0, coordinator.failure_penalty))
+
+    def test_work_stealing(self):
+        coordinator, context = self.coordinator({
+            self.members[0]: (10, shard_response([["a", 1]])),
+            self.members[1]: (0, shard_response([["b", 2]])),
+            self.standbys[0]: (0, shard_response([["c", 3]])),
+            })
+        coordinator.work_stealing = True
+        coordinator.members = lambda: [aiocoap.parallelism.Share([member], None)
+                for member in self.members * 3]
+
+        response = self.loop.run_until_complete(asyncio.wait_for(coordinator.render(
+            aiocoap.Message(code=aiocoap.PARALLELIZE, payload=b'{}')), 1))
+
+        self.assertEqual(json.loads(response.payload.decode('utf8')), [["b", 2]])
+        # the stalled member never got past its first chunk, which the
+        # others duplicated once they were done with everything else
+        hosts = [m.remote.hostinfo for m in context.sent]
+        self.assertEqual(hosts.count("192.0.2.1:5001"), 1)
+        self.assertEqual(len(hosts), 7)
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertTrue(context.responses[0].cancelled())
+
+    def test_work_stealing_plain_reducer(self):
+        # reducers without a start method get all responses at the end
+        coordinator, context = self.coordinator({
+            self.members[0]: (0, shard_response([["a", 1]])),
+            self.members[1]: (0, shard_response([["b", 2]])),
+            self.standbys[0]: (0, shard_response([["c", 3]])),
+            })
+        coordinator.work_stealing = True
+        coordinator.reducer = lambda request, responses, missing: aiocoap.Message(
+                code=aiocoap.COMPUTED, payload=b"%d" % len(responses))
+
+        response = self.render(coordinator)
+
+        self.assertEqual(response.payload, b"2")
+
+class SlowShardResource(aiocoap.resource.Resource):
+    async def render_parallelize(self, request):
+        await asyncio.sleep(0.2)
+        return shard_response([["a", 1]])
+
+class TestCoordinatorCancellation(WithTestServer, WithClient):
+    """Unlike the FakeContext, a real context keeps the exchange with a
+    member going after the coordinator gave up on it"""
+
+    def create_testing_site(self):
+        site = TestingSite()
+        site.add_resource(['slowshard'], SlowShardResource())
+        return site
+
+    @no_warnings
+    def test_deadline(self):
+        class Coordinator(aiocoap.parallelism.CoordinatorResource):
+            deadline = 0.05
+        coordinator = Coordinator(lambda: [(self.serveraddress, aiocoap.COAP_PORT)],
+                aiocoap.parallelism.TopKReducer(), ['slowshard'], self.client)
+
+        response = self.loop.run_until_complete(coordinator.render(
+            aiocoap.Message(code=aiocoap.PARALLELIZE, payload=b'{}')))
+        self.assertEqual(response.code, aiocoap.GATEWAY_TIMEOUT)
+
+        # the member's response arrives after the request to it was
+        # cancelled, which must neither fail nor be left unretrieved
+        self.loop.run_until_complete(asyncio.sleep(0.3))
+        gc.collect()
+
+class TestTopK(WithAsyncLoop):
+    def test_as_completed(self):
+        async def shard(delay, items):
+            await asyncio.sleep(delay)
+            return items
+
+        async def run():
+            results = []
+            async for best in aiocoap.parallelism.top_k_as_completed([
+                    shard(0.02, [("c", 3), ("e", 5)]),
+                    shard(0, [("b", 2), ("f", 6)]),
+                    shard(0.04, [("g", 7)]),
+                    ], 2, key=lambda item: item[1]):
+                results.append(best)
+            return results
+
+        # the slowest shard does not improve on the best two any more
+        self.assertEqual(self.loop.run_until_complete(run()), [
+            [("b", 2), ("f", 6)],
+            [("b", 2), ("c", 3)],
+            ])
+
+    def test_as_completed_failure(self):
+        slow = asyncio.ensure_future(asyncio.sleep(10, [("c", 3)]))
+
+        async def failing():
+            raise aiocoap.error.Error("shard failed")
+
+        async def run():
+            async for best in aiocoap.parallelism.top_k_as_completed([slow, failing()], 2):
+                pass
+
+        # the shard still running is cancelled along with the error
+        with self.assertRaises(aiocoap.error.Error):
+            self.loop.run_until_complete(run())
+        self.assertTrue(slow.cancelled())
+
+    def test_as_completed_early_stop(self):
+        slow = asyncio.ensure_future(asyncio.sleep(10, [("c", 3)]))
+
+        async def run():
+            async with aiocoap.parallelism.top_k_as_completed([slow, asyncio.sleep(0, [("b", 2)])],
+                    2, key=lambda item: item[1]) as completed:
+                async for best in completed:
+                    return best
+
+        self.assertEqual(self.loop.run_until_complete(run()), [("b", 2)])
+        self.assertTrue(slow.cancelled())
+
+class TestLeases(WithAsyncLoop):
+    def test_expiry(self):
+        expired = []
+        leases = aiocoap.parallelism.Leases(expired.append, self.loop)
+
+        async def run():
+            leases.renew("a", 0.05)
+            leases.renew("b", 0.1)
+            leases.renew("c", 0.1)
+            leases.cancel("c")
+            await asyncio.sleep(0.03)
+            # heartbeat
+            leases.renew("a", 0.2)
+            await asyncio.sleep(0.1)
+            self.assertEqual(expired, ["b"])
+            self.assertIn("a", leases)
+            await asyncio.sleep(0.15)
+
+        self.loop.run_until_complete(run())
+
+        self.assertEqual(expired, ["b", "a"])
+        self.assertEqual(len(leases), 0)
+
+class TestRendezvous(unittest.TestCase):
+    def owners(self, members, weights=None):
+        return [aiocoap.parallelism.rendezvous(key, members, weights)[0] for key in range(1000)]
+
+    def test_minimal_movement(self):
+        before = self.owners(["a", "b", "c", "d"])
+        after = self.owners(["a", "b", "d"])
+
+        # only the keys of the member that left move
+        for old, new in zip(before, after):
+            if old != "c":
+                self.assertEqual(old, new)
+        self.assertNotIn("c", after)
+
+    def test_weights(self):
+        owners = self.owners(["a", "b"], {"a": 3, "b": 1})
+        self.assertAlmostEqual(owners.count("a") / len(owners), 0.75, delta=0.05)
+
+if __name__ == "__main__":
+    unittest.main()
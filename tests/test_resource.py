@@ -0,0 +1,165 @@
+# This file is part of the Python aiocoap library project.
+#
+# Copyright (c) 2012-2014 Maciej Wasilak <http://sixpinetrees.blogspot.com/>,
+#               2013-2014 Christian Amsüss <c.amsuess@energyharvesting.at>
+#
+# aiocoap is free software, this file is published under the MIT license as
+# described in the accompanying LICENSE file.
+
+import asyncio
+import concurrent.futures
+import os
+import tempfile
+import threading
+import unittest
+
+import aiocoap
+import aiocoap.parallelism
+import aiocoap.resource
+
+from .fixtures import WithAsyncLoop
+
+class GatedResource(aiocoap.resource.Resource):
+    """Resource whose blocking GET handler waits for a gate to be opened"""
+
+    max_concurrency = 2
+
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(4)
+        self.threads = set()
+
+    @aiocoap.resource.blocking
+    def render_get(self, request):
+        self.threads.add(threading.current_thread())
+        self.gate.wait(5)
+        return aiocoap.Message(payload=b"done")
+
+class SquareResource(aiocoap.resource.Resource):
+    """Resource whose blocking POST handler tells which process it ran in"""
+
+    max_concurrency = 1
+
+    @aiocoap.resource.blocking
+    def render_post(self, request):
+        result = int(request.payload) ** 2
+        return aiocoap.Message(payload=("%d %d" % (result, os.getpid())).encode('ascii'))
+
+class TestBlockingRender(WithAsyncLoop):
+    def setUp(self):
+        super().setUp()
+        self.resource = GatedResource()
+
+    def tearDown(self):
+        self.resource.gate.set()
+        self.resource.executor.shutdown()
+        super().tearDown()
+
+    def test_concurrency_limit(self):
+        async def run():
+            renderings = [asyncio.ensure_future(self.resource.render(aiocoap.Message(code=aiocoap.GET)))
+                    for i in range(5)]
+
+            # let the renderings reach the executor or the queue
+            for i in range(20):
+                await asyncio.sleep(0.01)
+                if self.resource.get_blocking_statistics()["running"] == 2:
+                    break
+
+            self.assertEqual(self.resource.get_blocking_statistics(),
+                    {"queued": 3, "running": 2, "completed": 0, "max_queued": 3})
+
+            self.resource.gate.set()
+            responses = await asyncio.gather(*renderings)
+
+            self.assertEqual([r.payload for r in responses], [b"done"] * 5)
+            self.assertEqual([r.code for r in responses], [aiocoap.CONTENT] * 5)
+
+        self.loop.run_until_complete(run())
+
+        self.assertEqual(self.resource.get_blocking_statistics(),
+                {"queued": 0, "running": 0, "completed": 5, "max_queued": 3})
+        self.assertNotIn(threading.current_thread(), self.resource.threads)
+
+class TestBlockingRenderProcess(WithAsyncLoop):
+    def setUp(self):
+        super().setUp()
+        self.resource = SquareResource()
+        self.resource.executor = concurrent.futures.ProcessPoolExecutor(2)
+
+    def tearDown(self):
+        self.resource.executor.shutdown()
+        super().tearDown()
+
+    def test_process_pool(self):
+        async def run():
+            return await asyncio.gather(*(self.resource.render(
+                aiocoap.Message(code=aiocoap.POST, payload=str(i).encode('ascii')))
+                for i in range(3)))
+
+        responses = self.loop.run_until_complete(run())
+
+        results = [r.payload.decode('ascii').split() for r in responses]
+        self.assertEqual([int(result) for result, pid in results], [0, 1, 4])
+        self.assertNotIn(str(os.getpid()), [pid for result, pid in results])
+        self.assertEqual(self.resource.get_blocking_statistics(),
+                {"queued": 0, "running": 0, "completed": 3, "max_queued": 2})
+
+class TestParallelismDirectory(unittest.TestCase):
+    def setUp(self):
+        self.site = aiocoap.resource.Site()
+        self.site.set_up_as_parallelism_directory()
+        self.directory = ("192.0.2.1", 5000)
+        self.worker = ("192.0.2.2", 5001)
+
+    def test_memberships(self):
+        first = self.site.create_parallelism_entity(self.directory)
+        second = self.site.create_parallelism_entity(self.directory)
+        self.assertEqual((first, second), (0, 1))
+
+        self.site.add_parallelism_entity_member(first, self.worker)
+        self.site.add_parallelism_entity_member("1", self.worker)
+        self.assertEqual(sorted(self.site.find_parallelism_entities_for_member(self.worker)), ["0", "1"])
+        self.assertEqual(self.site.get_parallelism_entity_by_id(1), {self.directory, self.worker})
+
+        self.site.remove_parallelism_entity_member(second, self.worker)
+        self.assertEqual(self.site.find_parallelism_entities_for_member(self.worker), ["0"])
+        with self.assertRaises(ValueError):
+            self.site.remove_parallelism_entity_member(second, self.worker)
+        with self.assertRaises(KeyError):
+            self.site.add_parallelism_entity_member(2, self.worker)
+
+    def test_shut_down(self):
+        for i in range(3):
+            self.site.create_parallelism_entity(self.worker)
+
+        self.site.shut_down_parallelism_entity_member(self.worker)
+
+        self.assertEqual(self.site.find_parallelism_entities_for_member(self.worker), [])
+        self.assertEqual(self.site.all_parallelism_entities(), {"0": set(), "1": set(), "2": set()})
+
+    def test_journal(self):
+        path = os.path.join(tempfile.mkdtemp(), "entities")
+        journal = aiocoap.parallelism.Journal(path)
+        site = aiocoap.resource.Site()
+        site.set_up_as_parallelism_directory(journal)
+
+        site.create_parallelism_entity(self.directory)
+        site.create_parallelism_entity(self.directory)
+        site.add_parallelism_entity_member(0, self.worker)
+        site.add_parallelism_entity_member(1, self.worker)
+        site.remove_parallelism_entity_member(1, self.worker)
+        journal.close()
+
+        restored = aiocoap.resource.Site()
+        restored.set_up_as_parallelism_directory(aiocoap.parallelism.Journal(path))
+
+        self.assertEqual(restored.all_parallelism_entities(),
+                {"0": {self.directory, self.worker}, "1": {self.directory}})
+        self.assertEqual(restored.find_parallelism_entities_for_member(self.worker), ["0"])
+        # ids are still not reused
+        self.assertEqual(restored.create_parallelism_entity(self.directory), 2)
+
+if __name__ == "__main__":
+    unittest.main()